@@ -20,6 +20,8 @@ from .font import SetFontToBold
 from .utils.entity import Entity
 from .utils import memory
 from .utils.commands import ConnectShortcuts, Save, StopAllActions
+from .utils.beams import ReleaseBeams
+from .lattice.server import StartServer, StopServer
 from .utils.load import Load
 from . import style
 from . import shared
@@ -87,6 +89,8 @@ class MainWindow(Entity, QMainWindow):
             shared.lattice = latticeutils.LoadLattice(shared.latticePath)
             shared.elements = latticeutils.GetLatticeInfo(shared.lattice)
             shared.names = [a + f' [{shared.elements.Type[b]}] ({str(b)})' for a, b in zip(shared.elements.Name, shared.elements.Index)]
+        # start the simulation server in the background, so it holds the lattice before the first action needs it.
+        StartServer(shared.lattice)
         self.lightModeOn = False
         shared.mainWindow = self
         # Create a master widget to contain everything.
@@ -208,6 +212,8 @@ class MainWindow(Entity, QMainWindow):
         StopAllActions()
         if not self.quitShortcutPressed:
             Save()
+        ReleaseBeams()
+        StopServer()
         event.accept()
 
 def GetMainWindow():
@@ -0,0 +1,176 @@
+from at import transform_elem, Marker
+import numpy as np
+import time
+from copy import deepcopy
+from multiprocessing.shared_memory import SharedMemory
+from .orbitresponse import OrbitResponseAction
+from ...utils.multiprocessing import AttachSharedArrays, CloseSharedMemories, RunWorkers
+from ...utils.beams import SampleBeam, AttachBeam
+from ...lattice.latticeutils import ApplyBeamPipeAperture
+
+def SampleErrors(errors, numSeeds, seed = None):
+    '''Draws the pitch, yaw and roll (rad) of every element in `errors` for all `numSeeds` seeds at once, with shape numSeeds x numElements x 3.\n
+    Each entry of `errors` holds the `sigma` (mrad) of the normal distribution of each angle, which is used as the value itself where the angle is `fixed`.'''
+    sigma = np.array([e['sigma'] for e in errors], dtype = float).reshape(-1, 3)
+    fixed = np.array([e['fixed'] for e in errors], dtype = bool).reshape(-1, 3)
+    draws = np.random.default_rng(seed).standard_normal((numSeeds,) + sigma.shape)
+    return 1e-3 * np.where(fixed, sigma, draws * sigma)
+
+class ErrorEnsembleAction(OrbitResponseAction):
+    '''Tracks the beam through an ensemble of lattices with random alignment errors, and aggregates the orbit, transmission and ORM over the seeds.'''
+    def __init__(self):
+        super().__init__()
+        self.errors = [] # dict of the lattice `index`, `sigma` (mrad) and `fixed` flags of the pitch, yaw and roll of every element with errors.
+
+    def __getstate__(self):
+        return {**super().__getstate__(), 'errors': self.errors}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.errors = state['errors']
+
+    def Run(self, pause, stop, error, sharedMemoryName, shape, dtype, **kwargs):
+        '''Samples a set of alignment errors for each of the numSeeds rows of the data (numSeeds x numBPMs), applies it to a private lattice copy
+        and tracks the `beam` (pooled beam description) through it inside a beam pipe of half-width `aperture` (mm). Without a beam, one of `numParticles` is sampled
+        with `seed`, which also seeds the errors.\n
+        The data holds the orbit (mm) of every seed and `transmission` its surviving fraction. Each of the `numWorkers` worker processes keeps the running mean
+        and sum of squared deviations of the ORM of its seeds in its own slot of `ORMMoments`, counts them in `seedCounts` and bumps its `sequences` entry around
+        every update. While they run, the mean ORM (`ORM`), its spread across seeds (`fitErrors`) and the mean, 5th, 50th and 95th percentile orbit
+        (`orbitStatistics`) are aggregated into shared memory.'''
+        numSeeds = shape[0]
+        sharedMemory = SharedMemory(name = sharedMemoryName)
+        data = np.ndarray(shape, dtype, buffer = sharedMemory.buf)
+        sharedArrays = {
+            'ORM': (kwargs.get('postProcessedSharedMemoryName'), kwargs.get('postProcessedShape'), kwargs.get('postProcessedDType')),
+            **kwargs.get('additionalSharedMemory'),
+        }
+        sharedMemories, arrays = AttachSharedArrays(sharedArrays)
+        sharedMemories.append(sharedMemory)
+        try:
+            arrays['ORMMoments'][:] = 0
+            angles = SampleErrors(self.errors, numSeeds, kwargs.get('seed'))
+            beam = kwargs.get('beam') or SampleBeam(kwargs.get('numParticles', 10000), seed = kwargs.get('seed', 0))
+            numWorkers = len(arrays['seedCounts'])
+            seeds = np.array_split(np.arange(numSeeds), numWorkers)
+            self.aggregated = 0
+            self.snapshots = [(0, 0, 0., 0.)] * numWorkers # last consistent (sequence, count, mean, M2) read from each worker.
+            aperture = kwargs.get('aperture', 20)
+            if numWorkers == 1:
+                messages = [self.TrackSeeds(0, seeds[0], angles[seeds[0]], beam, aperture, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays, lambda: self.Aggregate(data, arrays))]
+            else:
+                state = {'lattice': self.lattice, 'BPMs': self.BPMs, 'correctors': self.correctors, 'errors': self.errors}
+                messages = RunWorkers(TrackSeeds, [
+                    (state, worker, seeds[worker], angles[seeds[worker]], beam, aperture, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays)
+                    for worker in range(numWorkers)
+                ], poll = lambda: self.Aggregate(data, arrays))
+            self.Aggregate(data, arrays)
+            CloseSharedMemories(sharedMemories)
+            message = next((m for m in messages if m is not None), None)
+            if message is not None:
+                error.set()
+            return message
+        except Exception as e:
+            CloseSharedMemories(sharedMemories)
+            error.set()
+            return f'{e}; Is this is the correct lattice and have all correctors and BPMs been linked correctly?'
+
+    def TrackSeeds(self, worker, seeds, angles, beam, aperture, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays, onSeed = None):
+        '''Applies the error `angles` (len(`seeds`) x numElements x 3, in rad) of each of the `seeds` to the lattice, then tracks the beam through it inside
+        a beam pipe of half-width `aperture` (mm), so particles that hit the pipe are lost. Writes the orbit and transmission of the seed
+        and folds its ORM into slot `worker` of the shared ORM moments. `onSeed` is called after every seed.\n
+        Returns an error message if something went wrong, else None.'''
+        sharedMemories = []
+        try:
+            # attached inside the try, so a worker that cannot attach still reports why.
+            sharedMemory = SharedMemory(name = sharedMemoryName)
+            sharedMemories.append(sharedMemory)
+            data = np.ndarray(shape, dtype, buffer = sharedMemory.buf)
+            attached, arrays = AttachSharedArrays(sharedArrays)
+            sharedMemories.extend(attached)
+            if isinstance(beam, tuple):
+                beamSharedMemory, beam = AttachBeam(beam)
+                sharedMemories.append(beamSharedMemory)
+            # the beam is tracked through a private copy of the lattice with an aperture in front of every element with length,
+            # so lattice index i sits at i plus the number of apertures up to and including it.
+            # A marker is added at the end, as the moments are taken entering each element.
+            trackingLattice = deepcopy(ApplyBeamPipeAperture(self.lattice, 1e-3 * aperture * np.array([-1, 1, -1, 1])))
+            trackingLattice.append(Marker('End'))
+            trackingIdxs = np.arange(len(self.lattice)) + np.cumsum([element.Length > 0 for element in self.lattice])
+            # BPMs linked to the same lattice element share a centroid.
+            BPMIdxs, rows = self.BPMRows()
+            # errors are set on both lattices, the tracked one for the orbit and this one for the analytic ORM.
+            elements = [(self.lattice[e['index']], trackingLattice[trackingIdxs[e['index']]]) for e in self.errors]
+            moments, counts, sequences = arrays['ORMMoments'][worker], arrays['seedCounts'], arrays['sequences']
+            for s, seedAngles in zip(seeds, angles):
+                # absolute transformations, so each seed replaces the errors of the one before.
+                for pair, (pitch, yaw, roll) in zip(elements, seedAngles):
+                    for element in pair:
+                        transform_elem(element, pitch = pitch, yaw = yaw, tilt = roll)
+                # moments mode keeps only segment boundary states, and resumes each seed from the segment of the first element with errors.
+                beamMoments = self.simulator.TrackMoments(trackingLattice, beam = beam)
+                centres = beamMoments['centroid'][trackingIdxs[BPMIdxs]][:, [0, 2]].T # 2 x numBPMIdxs, NaN where every particle is lost
+                data[s] = 1e3 * centres.reshape(-1)[rows]
+                arrays['transmission'][s] = beamMoments['transmission'][-1]
+                response = self.AnalyticResponse()[rows]
+                # Welford update, which stays accurate where the difference of raw sums of squares would cancel.
+                # The sequence is odd while the slot is written, so the aggregate can tell a torn read from a consistent one.
+                sequences[worker] += 1
+                counts[worker] += 1
+                delta = response - moments[0]
+                moments[0] += delta / counts[worker]
+                moments[1] += delta * (response - moments[0])
+                sequences[worker] += 1
+                if onSeed:
+                    onSeed()
+                # check for interrupts (including an error raised by another worker)
+                while pause.is_set():
+                    if stop.is_set():
+                        CloseSharedMemories(sharedMemories)
+                        return
+                    time.sleep(.1)
+                if stop.is_set() or error.is_set():
+                    CloseSharedMemories(sharedMemories)
+                    return
+            CloseSharedMemories(sharedMemories)
+        except Exception as e:
+            CloseSharedMemories(sharedMemories)
+            error.set()
+            return f'{e}; Is this is the correct lattice and have all correctors and BPMs been linked correctly?'
+
+    def Aggregate(self, data, arrays):
+        '''Publishes the mean and spread of the ORM and the orbit statistics over every seed completed so far, if any have completed since the last call.'''
+        for worker in range(len(self.snapshots)):
+            sequence = int(arrays['sequences'][worker])
+            if sequence % 2 or sequence == self.snapshots[worker][0]:
+                continue # mid update (the last snapshot is kept) or unchanged.
+            snapshot = (sequence, int(arrays['seedCounts'][worker]), arrays['ORMMoments'][worker, 0].copy(), arrays['ORMMoments'][worker, 1].copy())
+            if int(arrays['sequences'][worker]) == sequence:
+                self.snapshots[worker] = snapshot
+        snapshots = [s for s in self.snapshots if s[1] > 0]
+        total = sum(s[1] for s in snapshots)
+        if total == self.aggregated:
+            return
+        # Chan et al. merge of the per worker moments.
+        mean = sum(n * m for _, n, m, _ in snapshots) / total
+        M2 = sum(M2 + n * (m - mean) ** 2 for _, n, m, M2 in snapshots)
+        arrays['ORM'][:] = mean
+        arrays['fitCoefficients'][..., 1] = mean
+        arrays['fitErrors'][..., 1] = np.sqrt(M2 / total)
+        orbits = data[~np.isnan(data).all(axis = 1)]
+        with np.errstate(invalid = 'ignore'):
+            arrays['orbitStatistics'][0] = np.nanmean(orbits, axis = 0)
+            arrays['orbitStatistics'][1:] = np.nanpercentile(orbits, [5, 50, 95], axis = 0)
+        arrays['ORMMask'][:] = True
+        arrays['ORMVersion'] += 1
+        self.aggregated = total
+
+def TrackSeeds(state, worker, seeds, angles, beam, aperture, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays, queue):
+    '''Worker process target. Rebuilds the action from its `state` and tracks the error `seeds`.'''
+    action = ErrorEnsembleAction.__new__(ErrorEnsembleAction)
+    try:
+        action.__setstate__(state)
+    except Exception as e:
+        error.set()
+        queue.put(f'{e}; the worker could not rebuild the error ensemble action.')
+        return
+    queue.put(action.TrackSeeds(worker, seeds, angles, beam, aperture, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays))
@@ -2,9 +2,11 @@ import at
 from at import lattice_pass
 import numpy as np
 import time
-from copy import deepcopy
 from multiprocessing.shared_memory import SharedMemory
 from ..action import Action
+from ...utils.multiprocessing import AttachSharedArrays, CloseSharedMemories, RunWorkers
+from ...utils.linalg import FitPolynomial, CausalMask
+from ...utils.beams import SampleBeam, AttachBeam
 from ...simulator import Simulator
 from ... import shared
 
@@ -74,7 +76,16 @@ class OrbitResponseAction(Action):
 
     def Run(self, pause, stop, error, sharedMemoryName, shape, dtype, **kwargs):
         '''Calculates the orbit response of the model using PyAT simulations.\n
-        Accepts `correctors` (list of PVs) and `BPMs` (list of BPMs).'''
+        Accepts `correctors` (list of PVs) and `BPMs` (list of BPMs).\n
+        Set `engine` to `Analytic` to build the ORM from transfer matrices instead of particle tracking,
+        `Centroid` to track one centroid particle per kick step from each corrector, or `JAX` to differentiate a JAX linear model of the lattice.\n
+        `order` sets the polynomial order of the fit (1 = Linear, 2 = Quadratic).\n
+        Each corrector column is fitted and published as soon as it is complete, and flagged in the shared `ORMMask`. Its entry of `ORMVersion` is incremented every time a column is written.\n
+        If `coupledData` is among the additional shared arrays, both planes are recorded at every BPM lattice element and fitted into `coupledORM`.\n
+        `cachedColumns` maps column indices to data and fits from an earlier run, which are written straight in; only `columns` are measured.\n
+        `beam` is a pooled beam description (see utils.beams.PooledBeam) to track. Without one, a beam of `numParticles` is sampled with `seed`.'''
+        engine = kwargs.get('engine', 'Tracking')
+        order = kwargs.get('order', 1)
         numSteps = kwargs.get('numSteps')
         stepKick = kwargs.get('stepKick')
         repeats = kwargs.get('repeats')
@@ -83,61 +94,249 @@ class OrbitResponseAction(Action):
         data = np.ndarray(shape, dtype, buffer = sharedMemory.buf)
         numBPMs = len(self.BPMs)
         numCorrectors = len(self.correctors)
+        columns = np.array(kwargs.get('columns', np.arange(numCorrectors)), dtype = int)
         offset = int(numSteps / 2)
         kicks = (np.arange(0, numSteps, 1) - offset) * stepKick
+        # ORM, fit and completion mask arrays written as each column finishes.
+        sharedArrays = {
+            'ORM': (kwargs.get('postProcessedSharedMemoryName'), kwargs.get('postProcessedShape'), kwargs.get('postProcessedDType')),
+            **kwargs.get('additionalSharedMemory'),
+        }
+        sharedMemories, arrays = AttachSharedArrays(sharedArrays)
+        sharedMemories.append(sharedMemory)
         try:
-            # twiss in values for the LTB
-            # sigmaMat = at.sigma_matrix(betax = 3.731, betay = 2.128, alphax = -.0547, alphay = -.1263, emitx = 2.6e-7, emity = 2.6e-7, blength = 0, espread = 1.5e-2)
-            # twiss in values for the BTS
-            sigmaMat = at.sigma_matrix(betax = 12.13, betay = 2.94, alphax = -2.92, alphay = .75, emitx = 2.6e-7, emity = 2.6e-7, blength = 0, espread = 1.5e-2)
-            beam = at.beam(numParticles, sigmaMat)
+            self.RestoreColumns(data, kwargs.get('cachedColumns', dict()), arrays)
+            if engine in ['Analytic', 'Centroid', 'JAX']:
+                fill = {'Analytic': self.RunAnalytic, 'Centroid': self.RunCentroid, 'JAX': self.RunJAX}[engine]
+                fill(data, kicks * 1e-3, columns, arrays)
+                # To be consistent with units, convert kicks to units of rad to get an orbit response in m / rad = mm / mrad.
+                self.Fit(data, kicks * 1e-3, order, columns, arrays)
+                CloseSharedMemories(sharedMemories)
+                return
+            CloseSharedMemories(sharedMemories) # workers attach their own views of the shared arrays.
+            beam = kwargs.get('beam') or SampleBeam(numParticles, seed = kwargs.get('seed', 0))
+            message = self.RunTracking(pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays, columns, kicks, order, beam, kwargs.get('numWorkers', 1))
+            if error.is_set():
+                return message
+        except Exception as e:
+            CloseSharedMemories(sharedMemories)
+            error.set()
+            return f'{e}; Is this is the correct lattice and have all correctors and BPMs been linked correctly?'
+
+    def RunTracking(self, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays, columns, kicks, order, beam, numWorkers):
+        '''Tracks the `beam` (pooled beam description or array) for every kick step of the corrector `columns`. Returns an error message if something went wrong, else None.'''
+        # Each corrector column is independent, so split them across worker processes that write straight into the shared data.
+        numWorkers = max(1, min(numWorkers, len(columns)))
+        if numWorkers == 1:
+            messages = [self.TrackColumns(columns, beam, kicks, order, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays)]
+        else:
+            state = {'lattice': self.lattice, 'BPMs': self.BPMs, 'correctors': self.correctors}
+            messages = RunWorkers(TrackColumns, [
+                (state, columns, beam, kicks, order, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays)
+                for columns in np.array_split(columns, numWorkers)
+            ])
+        return next((m for m in messages if m is not None), None)
+
+    def TrackColumns(self, columns, beam, kicks, order, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays):
+        '''Tracks the orbit response of the corrector `columns`, writing the BPM centres into the shared data array.\n
+        Each column is fitted and flagged complete in the shared ORM arrays as soon as its kicks are done.\n
+        Returns an error message if something went wrong, else None.'''
+        sharedMemories = []
+        try:
+            # attached inside the try, so a worker that cannot attach still reports why.
+            sharedMemory = SharedMemory(name = sharedMemoryName)
+            sharedMemories.append(sharedMemory)
+            data = np.ndarray(shape, dtype, buffer = sharedMemory.buf)
+            attached, arrays = AttachSharedArrays(sharedArrays)
+            sharedMemories.extend(attached)
+            if isinstance(beam, tuple): # workers attach to the pooled beam instead of receiving a pickled copy.
+                beamSharedMemory, beam = AttachBeam(beam)
+                sharedMemories.append(beamSharedMemory)
+            # tracking is in place, so each pass refills preallocated scratch beams rather than copying the beam.
+            beamAtCorrector, scratch = np.empty_like(beam, order = 'F'), np.empty_like(beam, order = 'F')
+            # BPMs linked to the same lattice element share a refpt, so every BPM is read from a single pass.
+            BPMIdxs, rows = self.BPMRows()
             counter = 0
-            totalSteps = numCorrectors * numBPMs * numSteps * repeats
-            for col, c in enumerate(self.correctors):
+            totalSteps = len(columns) * len(kicks)
+            for col in columns:
+                c = self.correctors[col]
                 idx = 1 if c['alignment'] == 'Vertical' else 0
+                # BPMs upstream of the corrector cannot see its kicks, so the beam is tracked up to the corrector once and only the rest of the line is tracked per kick.
+                upstream = BPMIdxs <= c['index']
+                np.copyto(beamAtCorrector, beam)
+                centres = np.empty((2, len(BPMIdxs)))
+                if c['index'] > 0:
+                    centres[:, upstream] = self.TrackCentres(beamAtCorrector, BPMIdxs[upstream], end = c['index'])
                 for _, k in enumerate(kicks):
                     kickAngle = 1e-3 * (c['default'] + k) # convert the kick target value from mrad to rad.
                     # Should errors be applied to the value? ---- this will be added in a future version.
                     self.lattice[c['index']].KickAngle[idx] = kickAngle
-                    for row, b in enumerate(self.BPMs):
-                        BPMIdx = b['index']
-                        for r in range(repeats):
-                            beamOut = lattice_pass(self.lattice, deepcopy(beam), nturns = 1, refpts = np.array([BPMIdx])) # has shape 6 x numParticles x numRefpts x nturns
-                            centre = np.mean(beamOut[0, :, 0, 0]) if b['alignment'] == 'Horizontal' else np.mean(beamOut[2, :, 0, 0])
-                            data[row, col, _, r] = centre
-                            print(f'On step {counter} / {totalSteps}', end = '\r', flush = True)
-                            counter += 1
-                            # check for interrupts
-                            while pause.is_set():
-                                if stop.is_set():
-                                    sharedMemory.close()
-                                    return
-                                time.sleep(.1)
-                            if stop.is_set():
-                                sharedMemory.close()
-                                return
-                    # BPMs in the model are markers so we have the full phase space information but PVs will typically be separated into BPM:X, BPM:Y
-                    self.lattice[c['index']].KickAngle[idx] = 0
-            # To be consistent with units, convert kicks to units of rad to get an orbit response in m / rad = mm / mrad.
-            self.Fit(data, kicks * 1e-3, numCorrectors, numBPMs,
-                kwargs.get('postProcessedSharedMemoryName'),
-                kwargs.get('postProcessedShape'),
-                kwargs.get('postProcessedDType'),
-            )
-            sharedMemory.close() # remove this process' access to the shared data array.
+                    if not upstream.all():
+                        np.copyto(scratch, beamAtCorrector)
+                        centres[:, ~upstream] = self.TrackCentres(scratch, BPMIdxs[~upstream], start = c['index'])
+                    # The offline beam is identical for every repeat, so one pass fills all of them.
+                    readings = centres.reshape(-1)
+                    data[:, col, _, :] = readings[rows, None]
+                    if 'coupledData' in arrays:
+                        arrays['coupledData'][:, col, _, :] = readings[:, None]
+                    print(f'On step {counter} / {totalSteps}', end = '\r', flush = True)
+                    counter += 1
+                    # check for interrupts (including an error raised by another worker)
+                    while pause.is_set():
+                        if stop.is_set():
+                            CloseSharedMemories(sharedMemories)
+                            return
+                        time.sleep(.1)
+                    if stop.is_set() or error.is_set():
+                        CloseSharedMemories(sharedMemories)
+                        return
+                # BPMs in the model are markers so we have the full phase space information but PVs will typically be separated into BPM:X, BPM:Y
+                self.lattice[c['index']].KickAngle[idx] = 1e-3 * c['default']
+                # To be consistent with units, convert kicks to units of rad to get an orbit response in m / rad = mm / mrad.
+                self.Fit(data, kicks * 1e-3, order, [col], arrays)
+            CloseSharedMemories(sharedMemories)
         except Exception as e:
-            sharedMemory.close()
+            CloseSharedMemories(sharedMemories)
             error.set()
             return f'{e}; Is this is the correct lattice and have all correctors and BPMs been linked correctly?'
 
-    def Fit(self, data, kicks, numCorrectors, numBPMs, postProcessedSharedMemoryName, postProcessedShape, postProcessedDType):
-        '''Generates an Orbit Response Matrix using polyfit.'''
-        sharedMemory = SharedMemory(name = postProcessedSharedMemoryName)
-        postProcessedData = np.ndarray(postProcessedShape, postProcessedDType, buffer = sharedMemory.buf)
-        dataAveragedOverRepeats = data.mean(axis = 3)
-        for col in range(numCorrectors):
-            for row in range(numBPMs):
-                y = dataAveragedOverRepeats[row, col, :]
-                m, C = np.polyfit(kicks, y, deg = 1, cov = True)
-                postProcessedData[row, col] = m[0]
-        sharedMemory.close() # remove this process' access to the shared ORM array.
\ No newline at end of file
+    def TrackCentres(self, beam, refpts, start = 0, end = None):
+        '''Tracks `beam` (in place) once from lattice index `start` to `end` and returns the x and y beam centres at each of the `refpts` in between, with shape 2 x numRefpts.'''
+        beamOut = lattice_pass(self.lattice[start:end], beam, nturns = 1, refpts = refpts - start) # has shape 6 x numParticles x numRefpts x nturns
+        return np.mean(beamOut[[0, 2], :, :, 0], axis = 1)
+
+    def BPMRows(self):
+        '''Returns the sorted unique lattice indices of the BPMs and the row of each BPM in readings that hold
+        the x centre at every unique index followed by the y centre at every unique index.'''
+        refpts, inverse = np.unique(np.array([b['index'] for b in self.BPMs]), return_inverse = True)
+        planes = np.array([0 if b['alignment'] == 'Horizontal' else 1 for b in self.BPMs])
+        return refpts, planes * len(refpts) + inverse
+
+    def AnalyticResponse(self):
+        '''Returns the linear x then y response (m / rad) at every unique BPM lattice index to every corrector using PyAT transfer matrices.'''
+        numCorrectors = len(self.correctors)
+        correctorIdxs = np.array([c['index'] for c in self.correctors])
+        BPMIdxs, _ = self.BPMRows()
+        # transfer matrices from the start of the line to each corrector exit and each BPM
+        refpts, inverse = np.unique(np.concatenate([correctorIdxs + 1, BPMIdxs]), return_inverse = True)
+        _, ms = at.find_m44(self.lattice, refpts = refpts, orbit = np.zeros(6))
+        correctorMatrices, BPMMatrices = ms[inverse[:numCorrectors]], ms[inverse[numCorrectors:]]
+        # a unit kick inside a thick corrector also offsets the beam by half the corrector length at its exit.
+        kicks = np.zeros((numCorrectors, 4))
+        momentumIdxs = np.array([3 if c['alignment'] == 'Vertical' else 1 for c in self.correctors])
+        kicks[np.arange(numCorrectors), momentumIdxs] = 1
+        kicks[np.arange(numCorrectors), momentumIdxs - 1] = np.array([self.lattice[idx].Length for idx in correctorIdxs]) / 2
+        # propagate each kick from its corrector to every BPM -> shape numBPMs x numCorrectors x 4
+        response = np.einsum('bij,cjk,ck->bci', BPMMatrices, np.linalg.inv(correctorMatrices), kicks)
+        response = np.concatenate([response[..., 0], response[..., 2]])
+        # BPMs upstream of a corrector cannot see its kick.
+        return np.where(CausalMask(np.tile(BPMIdxs, 2), correctorIdxs), response, 0)
+
+    def JAXResponse(self):
+        '''Returns the linear x then y response (m / rad) at every unique BPM lattice index to every corrector, as the Jacobian of the JAX linear model of the lattice.'''
+        from ...lattice.jaxtracker import JAXTracker # jax is only needed by this engine.
+        BPMIdxs, _ = self.BPMRows()
+        # horizontal and vertical correctors can share an element, so each element is differentiated once.
+        elementIdxs, inverse = np.unique([c['index'] for c in self.correctors], return_inverse = True)
+        planes = np.array([1 if c['alignment'] == 'Vertical' else 0 for c in self.correctors])
+        tracker = JAXTracker(self.lattice)
+        response = np.asarray(tracker.OrbitResponse(tracker.parameters, tuple(int(i) for i in elementIdxs), tuple(int(i) for i in BPMIdxs)))
+        return response[:, inverse, planes]
+
+    def RunJAX(self, data, kicks, columns, arrays):
+        '''Fills the raw data of the corrector `columns` with the linear model of each BPM reading from the JAX Jacobian.\n
+        `kicks` are the step offsets in rad.'''
+        self.RunAnalytic(data, kicks, columns, arrays, self.JAXResponse())
+
+    def RunAnalytic(self, data, kicks, columns, arrays, response = None):
+        '''Fills the raw data of the corrector `columns` with the linear model of each BPM reading, without tracking.\n
+        `kicks` are the step offsets in rad. `response` defaults to the AnalyticResponse.'''
+        _, rows = self.BPMRows()
+        response = (self.AnalyticResponse() if response is None else response)[:, columns]
+        kickAngles = 1e-3 * np.array([self.correctors[col]['default'] for col in columns])[:, None] + kicks[None, :]
+        readings = response[:, :, None] * kickAngles[None, :, :]
+        data[:, columns] = readings[rows, ..., None]
+        if 'coupledData' in arrays:
+            arrays['coupledData'][:, columns] = readings[..., None]
+
+    def RunCentroid(self, data, kicks, columns, arrays):
+        '''Fills the raw data of the corrector `columns` by tracking the beam centroid instead of a full beam.\n
+        A kick is a transverse momentum offset at the corrector exit, so each corrector tracks one particle per kick step
+        once from the corrector to the end of the line. BPMs upstream of the corrector see the reference orbit.\n
+        `kicks` are the step offsets in rad.'''
+        numCorrectors = len(self.correctors)
+        correctorIdxs = np.array([c['index'] for c in self.correctors])
+        BPMIdxs, rows = self.BPMRows()
+        # the response is measured about the working point of every corrector.
+        for c in self.correctors:
+            self.lattice[c['index']].KickAngle[1 if c['alignment'] == 'Vertical' else 0] = 1e-3 * c['default']
+        # reference centroid at the entrance of every corrector and BPM
+        refpts, inverse = np.unique(np.concatenate([correctorIdxs, BPMIdxs]), return_inverse = True)
+        reference = lattice_pass(self.lattice, np.zeros((6, 1), order = 'F'), nturns = 1, refpts = refpts)[:, 0, :, 0] # 6 x numRefpts
+        correctorCentres = reference[:, inverse[:numCorrectors]]
+        BPMCentres = reference[[0, 2]][:, inverse[numCorrectors:]] # 2 x numBPMIdxs
+        for col in columns:
+            c = self.correctors[col]
+            momentumIdx = 3 if c['alignment'] == 'Vertical' else 1
+            # one centroid particle per kick step, passed through the corrector at its working point (updated in place).
+            particles = np.asfortranarray(np.repeat(correctorCentres[:, col, None], len(kicks), axis = 1))
+            lattice_pass(self.lattice[c['index']:c['index'] + 1], particles, nturns = 1)
+            # a kick inside a thick corrector also offsets the beam by half the corrector length at its exit.
+            particles[momentumIdx] += kicks
+            particles[momentumIdx - 1] += self.lattice[c['index']].Length / 2 * kicks
+            centres = np.repeat(BPMCentres[..., None], len(kicks), axis = 2) # 2 x numBPMIdxs x numSteps
+            downstream = BPMIdxs > c['index']
+            if np.any(downstream):
+                particlesOut = lattice_pass(self.lattice[c['index'] + 1:], particles, nturns = 1, refpts = BPMIdxs[downstream] - c['index'] - 1) # 6 x numSteps x numRefpts x nturns
+                centres[:, downstream] = particlesOut[[0, 2], :, :, 0].transpose(0, 2, 1)
+            centres = centres.reshape(-1, len(kicks))
+            data[:, col] = centres[rows, :, None]
+            if 'coupledData' in arrays:
+                arrays['coupledData'][:, col] = centres[..., None]
+
+    def RestoreColumns(self, data, cachedColumns, arrays):
+        '''Writes the raw data and fits of columns measured in an earlier run and flags them in `ORMMask`.\n
+        `cachedColumns` maps each column index to a dict of `data`, `coefficients` and `errors` for every BPM,
+        plus `coupledData`, `coupledCoefficients` and `coupledErrors` for coupled runs.'''
+        for col, cached in cachedColumns.items():
+            data[:, col] = cached['data']
+            arrays['fitCoefficients'][:, col] = cached['coefficients']
+            arrays['fitErrors'][:, col] = cached['errors']
+            arrays['ORM'][:, col] = cached['coefficients'][:, 1]
+            if 'coupledData' in arrays:
+                arrays['coupledData'][:, col] = cached['coupledData']
+                arrays['coupledFitCoefficients'][:, col] = cached['coupledCoefficients']
+                arrays['coupledFitErrors'][:, col] = cached['coupledErrors']
+                arrays['coupledORM'][:, col] = cached['coupledCoefficients'][:, 1]
+            arrays['ORMMask'][col] = True
+            arrays['ORMVersion'][col] += 1
+
+    def Fit(self, data, kicks, order, columns, arrays):
+        '''Fits the corrector `columns` of the Orbit Response Matrix with one batched least squares solve over every (BPM, corrector) pair.\n
+        `order` is the polynomial order (1 = linear, 2 = quadratic) and `kicks` the step offsets from each corrector\'s working point.\n
+        Intercepts, slopes (and curvatures) are stored in `fitCoefficients` and their standard errors in `fitErrors`,
+        and likewise for the coupled arrays if present. The columns are flagged in `ORMMask` once written and their `ORMVersion` incremented.'''
+        BPMIdxs, rows = self.BPMRows()
+        causal = CausalMask(np.tile(BPMIdxs, 2), np.array([self.correctors[col]['index'] for col in columns]))
+        coefficients, errors = FitPolynomial(data[:, columns].mean(axis = 3), kicks, order)
+        arrays['fitCoefficients'][:, columns] = coefficients
+        arrays['fitErrors'][:, columns] = errors
+        arrays['ORM'][:, columns] = np.where(causal[rows], coefficients[..., 1], 0) # slope at the working point, structurally zero upstream.
+        if 'coupledData' in arrays:
+            coefficients, errors = FitPolynomial(arrays['coupledData'][:, columns].mean(axis = 3), kicks, order)
+            arrays['coupledFitCoefficients'][:, columns] = coefficients
+            arrays['coupledFitErrors'][:, columns] = errors
+            arrays['coupledORM'][:, columns] = np.where(causal, coefficients[..., 1], 0)
+        arrays['ORMMask'][columns] = True
+        arrays['ORMVersion'][columns] += 1 # each column is only written by one process, so per column counters never race.
+
+def TrackColumns(state, columns, beam, kicks, order, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays, queue):
+    '''Worker process target. Rebuilds the action from its `state` and tracks the corrector `columns`.'''
+    action = OrbitResponseAction.__new__(OrbitResponseAction)
+    try:
+        action.__setstate__(state)
+    except Exception as e:
+        error.set()
+        queue.put(f'{e}; the worker could not rebuild the orbit response action.')
+        return
+    queue.put(action.TrackColumns(columns, beam, kicks, order, pause, stop, error, sharedMemoryName, shape, dtype, sharedArrays))
\ No newline at end of file
@@ -1,10 +1,13 @@
-import at
 from at import lattice_pass
 import numpy as np
-from copy import deepcopy
+import time
 from multiprocessing.shared_memory import SharedMemory
 from ..action import Action
+from ...utils.multiprocessing import AttachSharedArrays, CloseSharedMemories
+from ...utils.beams import SampleBeam, AttachBeam
+from ...utils.linalg import TruncatedPseudoInverse
 from ...simulator import Simulator
+from ...lattice.server import SimulationClient
 from ... import shared
 
 class SVDAction(Action):
@@ -36,6 +39,7 @@ class SVDAction(Action):
                     'alignment': c.settings['alignment'],
                     'value': c.settings['components']['value']['value'],
                     'default': c.settings['components']['value']['default'],
+                    'kickAngle': np.array(getattr(shared.lattice[c.settings['linkedElement'].Index], 'KickAngle', np.zeros(2)), dtype = float), # rad
                     'linkedElementAttrs': c.linkedElementAttrs,
                 }
                 for c in self.correctors.values()
@@ -72,38 +76,128 @@ class SVDAction(Action):
         return True
     
     def Run(self, pause, stop, error, sharedMemoryName, shape, dtype, **kwargs):
-        '''Computes the beam trajectory along the beamline.'''
+        '''Computes the beam trajectory along the beamline.\n
+        Column 1 of the data holds the tracked trajectory and column 2 the change predicted by the ORM for the set corrector values.
+        The shared `predictions` array (truncations x BPMs) holds the trajectory predicted after correcting with each truncation of the SVD.\n
+        Set `closedLoop` to iteratively correct the trajectory instead (see `RunClosedLoop`).\n
+        `beam` is a pooled beam description (see utils.beams.PooledBeam) to track. Without one, a beam of `numParticles` is sampled with `seed`.\n
+        Pass the `server` description (see lattice.server.SyncServer) with a `beam` to track on the resident simulation server, in which case the action is sent
+        without a lattice. Otherwise the private lattice is tracked.'''
         numParticles = kwargs.get('numParticles', 10000)
         sharedMemory = SharedMemory(name = sharedMemoryName)
         data = np.ndarray(shape, dtype, buffer = sharedMemory.buf)
+        sharedMemories, arrays = AttachSharedArrays(kwargs.get('additionalSharedMemory', dict()))
+        sharedMemories.append(sharedMemory)
         data[:, 0] = np.array([b['pos'] for b in self.BPMs])
         # first compute the nominal trajectory predicted by the ORM
         # before this point, the ORM has been calculated around the working point of the correctors
         # corrector strengths are in mrad at this point and U/s/VT produce ORM with units mm / mrad
+        client = None
         try:
-            # twiss in values for the LTB
-            # sigmaMat = at.sigma_matrix(betax = 3.731, betay = 2.128, alphax = -.0547, alphay = -.1263, emitx = 2.6e-7, emity = 2.6e-7, blength = 0, espread = 1.5e-2)
-            # twiss in values for the BTS
-            sigmaMat = at.sigma_matrix(betax = 12.13, betay = 2.94, alphax = -2.92, alphay = .75, emitx = 2.6e-7, emity = 2.6e-7, blength = 0, espread = 1.5e-2)
-            beam = at.beam(numParticles, sigmaMat)
-            arr, idxs, inv = np.unique(np.array([b['index'] for b in self.BPMs]), return_index = True, return_inverse = True)
-            # calculate the nominal trajectory through the lattice
-            beamOut = lattice_pass(self.lattice, deepcopy(beam), nturns = 1, refpts = arr) # has shape 6 x numParticles x numRefpts x nturns
-            # get horizontal BPM list idxs
-            xIdxs = [idxs[inv[i]] for i, b in enumerate(self.BPMs) if b['alignment'] == 'Horizontal']
-            yIdxs = [idxs[inv[i]] for i, b in enumerate(self.BPMs) if b['alignment'] == 'Vertical']
-            # get horizontal centres
-            xCentres = np.mean(beamOut[0, :, xIdxs, 0], 1) * 1e3 # convert back to mm at the end
-            yCentres = np.mean(beamOut[2, :, yIdxs, 0], 1) * 1e3
-            S = np.zeros((len(self.BPMs), len(self.correctors)))
-            np.fill_diagonal(S, self.s) # modifies matrix in-place
-            ORM = self.U @ S @ self.VT
+            # the server tracks the pooled beam from its description, so it is only attached here for the private lattice.
+            if kwargs.get('server') and kwargs.get('beam'):
+                client = SimulationClient(*kwargs['server'])
+                beam = kwargs['beam']
+            elif kwargs.get('beam'):
+                beamSharedMemory, beam = AttachBeam(kwargs['beam'])
+                sharedMemories.append(beamSharedMemory)
+            else:
+                beam = SampleBeam(numParticles, seed = kwargs.get('seed', 0))
+            if kwargs.get('closedLoop', False):
+                self.RunClosedLoop(pause, stop, data, arrays, beam, client, kwargs.get('truncation'), kwargs.get('tolerance', 1e-2), kwargs.get('maxIterations', 20), kwargs.get('gain', 1))
+                self.Disconnect(client, sharedMemories)
+                return
+            ORM = (self.U * self.s) @ self.VT # economy SVD, so U and VT only hold the vectors of nonzero singular values.
             cVec = np.array([c['value'] - c['default'] for c in self.correctors])[:, None] # convert to column vector
             # We solve (and inverse of) dBPMx = ORM dtheta (BPMs orders, x then y, and within those bins, by index & same for correctors)
             # 1. calculate the predicted trajectory for the set corrector values
             dBPM = ORM @ cVec
-            data[:, 1] = np.concatenate([xCentres, yCentres]) # tracking output
+            trajectory = self.TrackTrajectory(beam, client)
+            data[:, 1] = trajectory # tracking output
+            data[:, 2] = dBPM[:, 0]
+            # 2. predict the trajectory after correcting with every truncation of the SVD in one pass
+            if 'predictions' in arrays:
+                arrays['predictions'][:] = self.PredictCorrections(trajectory)
+            self.Disconnect(client, sharedMemories)
         except Exception as e:
-            sharedMemory.close()
+            self.Disconnect(client, sharedMemories)
             error.set()
-            return e
\ No newline at end of file
+            return e
+
+    def Disconnect(self, client, sharedMemories):
+        '''Closes the simulation `client` (if any) and the `sharedMemories` of a run.'''
+        if client is not None:
+            client.Close()
+        CloseSharedMemories(sharedMemories)
+
+    def TrackTrajectory(self, beam, client = None, overrides = None):
+        '''Tracks a copy of `beam` through the lattice and returns the beam centre (mm) at every BPM, horizontal BPMs first.\n
+        With a simulation `client`, `beam` is a pooled beam description and only the centroids are tracked and returned by the server,
+        with the attribute `overrides` (see SimulationClient.Track) applied for this pass.'''
+        arr, inv = np.unique(np.array([b['index'] for b in self.BPMs]), return_inverse = True)
+        xIdxs = [inv[i] for i, b in enumerate(self.BPMs) if b['alignment'] == 'Horizontal']
+        yIdxs = [inv[i] for i, b in enumerate(self.BPMs) if b['alignment'] == 'Vertical']
+        if client is not None:
+            centres = client.Track(beam, arr, overrides, reduction = 'centroid')
+            return np.concatenate([centres[0, xIdxs], centres[2, yIdxs]]) * 1e3
+        # calculate the nominal trajectory through the lattice
+        # tracking is in place, so the beam is copied into a scratch array that is reused between calls.
+        if getattr(self, 'scratch', np.empty(0)).shape != beam.shape:
+            self.scratch = np.empty_like(beam, order = 'F')
+        np.copyto(self.scratch, beam)
+        beamOut = lattice_pass(self.lattice, self.scratch, nturns = 1, refpts = arr) # has shape 6 x numParticles x numRefpts x nturns
+        # get horizontal centres
+        xCentres = np.mean(beamOut[0, :, xIdxs, 0], 1) * 1e3 # convert back to mm at the end
+        yCentres = np.mean(beamOut[2, :, yIdxs, 0], 1) * 1e3
+        return np.concatenate([xCentres, yCentres])
+
+    def RunClosedLoop(self, pause, stop, data, arrays, beam, client, truncation, tolerance, maxIterations, gain):
+        '''Repeatedly tracks the trajectory, applies `gain` times the truncated SVD correction to the correctors and re-tracks,
+        until the RMS trajectory falls below `tolerance` (mm), stops improving or `maxIterations` corrections have been applied.\n
+        With a simulation `client` the corrections are sent as per pass overrides, so the resident lattice is left as it is. Otherwise they are applied to the private lattice.\n
+        The live trajectory is written to column 1 of the data, the RMS trajectory (mm) and RMS corrector strength (mrad) of every iteration
+        to the shared `loopHistory` array and the total correction (mrad) to `loopCorrections`.'''
+        truncation = len(self.s) if truncation is None else min(truncation, len(self.s))
+        pseudoInverse = TruncatedPseudoInverse(self.U, self.s, self.VT, truncation)
+        planes = np.array([1 if c['alignment'] == 'Vertical' else 0 for c in self.correctors])
+        strengths = np.array([c['value'] for c in self.correctors], dtype = float) # mrad
+        corrections = np.zeros(len(self.correctors))
+        previousRMS = np.inf
+        for iteration in range(maxIterations + 1):
+            trajectory = self.TrackTrajectory(beam, client, self.KickOverrides(planes, corrections) if client is not None else None)
+            data[:, 1] = trajectory
+            data[:, 2] = (self.U * self.s) @ (self.VT @ corrections) # trajectory change the ORM predicts for the corrections so far
+            rms = np.sqrt(np.mean(trajectory ** 2))
+            arrays['loopHistory'][iteration] = rms, np.sqrt(np.mean((strengths + corrections) ** 2))
+            arrays['loopCorrections'][:] = corrections
+            # stop once converged, or once the correctors can no longer reduce the trajectory.
+            if rms < tolerance or iteration == maxIterations or rms > previousRMS * (1 - 1e-6):
+                return
+            previousRMS = rms
+            step = -gain * pseudoInverse @ trajectory
+            corrections += step
+            if client is None:
+                for c, plane, kick in zip(self.correctors, planes, step):
+                    self.lattice[c['index']].KickAngle[plane] += kick * 1e-3 # mrad -> rad
+            # check for interrupts
+            while pause.is_set():
+                if stop.is_set():
+                    return
+                time.sleep(.1)
+            if stop.is_set():
+                return
+
+    def KickOverrides(self, planes, corrections):
+        '''Returns the server overrides setting the kick angle of every corrector element to its lattice value plus the `corrections` (mrad) in the `planes` of the correctors.'''
+        overrides = dict()
+        for c, plane, correction in zip(self.correctors, planes, corrections):
+            # horizontal and vertical correctors linked to the same element share its override.
+            kickAngle = overrides.setdefault(c['index'], {'KickAngle': c['kickAngle'].copy()})['KickAngle']
+            kickAngle[plane] += correction * 1e-3 # mrad -> rad
+        return overrides
+
+    def PredictCorrections(self, trajectory):
+        '''Returns the trajectory left after applying the correction -pinv(ORM) `trajectory`, for every truncation of the SVD (truncations x BPMs).\n
+        Truncating to k modes removes the projection of the trajectory onto the first k left singular vectors, so every level follows from one cumulative sum.'''
+        projections = self.U.T @ trajectory
+        return trajectory[None, :] - np.cumsum(projections[:, None] * self.U.T, axis = 0)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import numpy as np
+import time
+from scipy.linalg import hadamard
+from multiprocessing.shared_memory import SharedMemory
+from ..offline.orbitresponse import OrbitResponseAction as OfflineOrbitResponseAction
+from ...utils.multiprocessing import AttachSharedArrays, CloseSharedMemories
+from ...utils.linalg import TikhonovSolve, CausalMask
+
+def ExcitationPatterns(excitation, numCorrectors, seed = None):
+    '''Returns the +-1 kick sign of every corrector for each measurement, with shape numPatterns x numCorrectors.\n
+    `Hadamard` patterns are mutually orthogonal, so the reconstruction is perfectly conditioned once all of them are measured.
+    `Random` patterns are drawn independently (twice as many as correctors) so a run can be stopped at any point.'''
+    if excitation == 'Hadamard':
+        order = 2 ** int(np.ceil(np.log2(max(numCorrectors, 1))))
+        return hadamard(order)[:, :numCorrectors].astype(float)
+    return np.random.default_rng(seed).choice([-1., 1.], size = (2 * numCorrectors, numCorrectors))
+
+class OrbitResponseAction(OfflineOrbitResponseAction):
+    '''Measures the orbit response of the machine by driving every corrector at once with a sequence of excitation patterns.\n
+    The ORM is recovered from all patterns measured so far by regularised least squares, so it is updated after every magnet settle.'''
+    def Run(self, pause, stop, error, sharedMemoryName, shape, dtype, **kwargs):
+        '''Accepts `excitations` (numPatterns x numCorrectors kick signs), `stepKick` (mrad), `repeats`, `settleTime` (s) and `regularisation`.\n
+        The raw data holds every BPM reading (mm) at the working point followed by each pattern, and `conditioning` the condition number
+        of the kicks measured so far, which reaches 1 for a complete set of orthogonal patterns.'''
+        try:
+            from cothread.catools import caget, caput # EPICS is only available on machines with access to the control system.
+        except ImportError:
+            error.set()
+            return 'cothread is not installed, so online orbit response measurements are unavailable.'
+        excitations = kwargs.get('excitations')
+        stepKick = kwargs.get('stepKick')
+        repeats = kwargs.get('repeats')
+        settleTime = kwargs.get('settleTime', .2)
+        regularisation = kwargs.get('regularisation', 1e-3)
+        sharedMemory = SharedMemory(name = sharedMemoryName)
+        data = np.ndarray(shape, dtype, buffer = sharedMemory.buf)
+        sharedMemories, arrays = AttachSharedArrays({
+            'ORM': (kwargs.get('postProcessedSharedMemoryName'), kwargs.get('postProcessedShape'), kwargs.get('postProcessedDType')),
+            **kwargs.get('additionalSharedMemory'),
+        })
+        sharedMemories.append(sharedMemory)
+        correctorNames = [c['name'] for c in self.correctors]
+        BPMNames = [b['name'] for b in self.BPMs]
+        defaults = np.array([c['default'] for c in self.correctors])
+        causal = CausalMask([b['index'] for b in self.BPMs], [c['index'] for c in self.correctors])
+        try:
+            for p in range(len(excitations) + 1):
+                # the first measurement is taken at the working point of every corrector.
+                kicks = excitations[p - 1] * stepKick if p > 0 else np.zeros(len(defaults))
+                caput(correctorNames, defaults + kicks, wait = True)
+                time.sleep(settleTime)
+                for r in range(repeats):
+                    data[:, p, r] = caget(BPMNames)
+                    time.sleep(.2)
+                if p > 0:
+                    self.Estimate(data[:, :p + 1].mean(axis = 2), excitations[:p] * stepKick, regularisation, causal, arrays)
+                # check for interrupts
+                while pause.is_set():
+                    if stop.is_set():
+                        return
+                    time.sleep(.1)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            error.set()
+            return f'{e}; Are all corrector and BPM names valid PVs?'
+        finally:
+            caput(correctorNames, defaults, wait = True) # always return the machine to its working point.
+            CloseSharedMemories(sharedMemories)
+
+    def Estimate(self, readings, kicks, regularisation, causal, arrays):
+        '''Reconstructs the ORM (mm / mrad) from the mean BPM `readings` (numBPMs x (numPatterns + 1), working point first)
+        and the `kicks` (numPatterns x numCorrectors) applied so far.\n
+        `regularisation` is relative to the mean squared kick, so it bounds the response of correctors that have not yet been excited independently.'''
+        offsets = readings[:, 1:] - readings[:, :1]
+        numPatterns, numCorrectors = kicks.shape
+        penalty = regularisation * np.mean(kicks ** 2) * numPatterns
+        ORM = TikhonovSolve(kicks, offsets.T, penalty).T
+        singularValues = np.linalg.svd(kicks, compute_uv = False)
+        arrays['conditioning'][numPatterns - 1] = singularValues[0] / singularValues[-1] if numPatterns >= numCorrectors and singularValues[-1] > 1e-12 * singularValues[0] else np.inf
+        # standard errors from the residual scatter, once there are more patterns than unknowns
+        if numPatterns > numCorrectors:
+            variance = np.sum((offsets - ORM @ kicks.T) ** 2, axis = 1) / (numPatterns - numCorrectors)
+            arrays['fitErrors'][..., 1] = np.sqrt(variance[:, None] * np.diag(np.linalg.inv(kicks.T @ kicks + penalty * np.eye(numCorrectors)))[None, :])
+        arrays['fitCoefficients'][..., 0] = readings[:, :1]
+        arrays['fitCoefficients'][..., 1] = ORM
+        arrays['ORM'][:] = np.where(causal, ORM, 0)
+        arrays['ORMMask'][:] = True
+        arrays['ORMVersion'] += 1
@@ -1,31 +1,76 @@
-from PySide6.QtWidgets import QGraphicsProxyWidget, QSpacerItem, QSizePolicy
-from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QGraphicsProxyWidget, QSpacerItem, QSizePolicy, QWidget, QLabel, QMenu, QPushButton, QHBoxLayout, QFileDialog
+from PySide6.QtCore import Qt, QPoint
 import numpy as np
-from scipy.linalg import svd
+import pandas as pd
+import os
+from datetime import datetime
 from copy import deepcopy
 from .composition import Composition
 from ...components.slider import SliderComponent
 from ...ui.runningcircle import RunningCircle
 from ...actions.offline.svd import SVDAction
-from ...utils.multiprocessing import PerformAction, TogglePause, StopAction
+from ...utils.multiprocessing import PerformAction, runningActions
+from ...utils.beams import PooledBeam
+from ...lattice.server import SyncServer, CacheStatistics
+from ...utils.linalg import CausalSVD, PseudoInverseLadder, SolveCorrections, ReplaceColumn
 from ... import shared
 from ... import style
 
 class SVD(Composition):
     def __init__(self, parent, proxy: QGraphicsProxyWidget, **kwargs):
-        super().__init__(parent, proxy, name = kwargs.pop('name', 'SVD'), type = 'SVD', size = kwargs.pop('size', [500, 200]), **kwargs)
+        super().__init__(parent, proxy, name = kwargs.pop('name', 'SVD'), type = 'SVD', size = kwargs.pop('size', [500, 330]), **kwargs)
         self.AddButtons('pause', 'stop','clear')
         self.start.setText('Calculate Trajectory')
+        self.solve = QPushButton('Solve Orbits')
+        self.solve.setFixedHeight(35)
+        self.solve.setStyleSheet(style.PushButtonStyle(padding = 0, color = '#2e2e2e', fontColor = '#c4c4c4'))
+        self.solve.clicked.connect(self.SolveOrbits)
+        self.buttons.layout().addWidget(self.solve)
+        self.closeLoop = QPushButton('Close Loop')
+        self.closeLoop.setFixedHeight(35)
+        self.closeLoop.setStyleSheet(style.PushButtonStyle(padding = 0, color = '#2e2e2e', fontColor = '#c4c4c4'))
+        self.closeLoop.clicked.connect(self.StartClosedLoop)
+        self.buttons.layout().addWidget(self.closeLoop)
         self.s, self.U, self.VT = np.zeros(0,), np.zeros(0,), np.zeros(0,)
+        self.SVDVersion = None # version of the upstream ORM and settings that U, s and VT were computed from.
+        self.columnVersions = np.empty((0,), dtype = np.int64) # write count of each ORM column when it was last folded into U, s and VT.
+        self.pseudoInverses = np.zeros((0, 0, 0)) # pseudo-inverse of the ORM at every truncation level.
+        self.predictions = np.zeros((0, 0)) # corrected trajectory predicted at every truncation level.
+        self.loopHistory = np.zeros((0, 2)) # RMS trajectory (mm) and RMS corrector strength (mrad) of each closed loop iteration.
+        # closed loop correction against the simulator
+        self.settings['loopTolerance'] = 1e-2 # mm
+        self.settings['loopIterations'] = 20
+        self.settings['loopGain'] = 1
+        self.settings['method'] = 'Economy'
+        self.settings['seed'] = 0 # seed of the pooled beam, so the trajectory is tracked with the same particles as a linked orbit response.
         self.correctors = dict()
         self.BPMs = dict()
         print('self.s has length:', len(self.s))
         self.settings['components'] = {
-            'truncation': dict(name = 'truncation', value = max(len(self.s), 1), min = 1, max = max(1, len(self.s)), default = len(self.s), units = '', valueType = int, type = SliderComponent)
+            'truncation': dict(name = 'truncation', value = max(len(self.s), 1), min = 1, max = max(1, len(self.s)), default = len(self.s), units = '', valueType = int, type = SliderComponent),
+            'modes': dict(name = 'modes', value = 20, min = 1, max = 200, default = 20, units = '', valueType = int, type = SliderComponent),
         }
         self.offlineAction = SVDAction()
         self.runningCircle = RunningCircle()
         self.header.layout().addWidget(self.runningCircle, alignment = Qt.AlignRight)
+        # SVD method
+        self.method = QWidget()
+        self.method.setLayout(QHBoxLayout())
+        self.method.layout().setContentsMargins(15, 10, 15, 0)
+        self.methodTitle = QLabel('SVD method')
+        self.methodTitle.setStyleSheet(style.LabelStyle(fontColor = '#c4c4c4', padding = 0))
+        self.methodMenu = QMenu()
+        self.methodOptions = QPushButton(f'{self.settings['method']:<14}\u25BC')
+        self.methodOptions.setStyleSheet(style.PushButtonStyle(color = '#1e1e1e', fontColor = '#c4c4c4', padding = 5, textAlign = 'right'))
+        self.methodOptions.setFixedWidth(115)
+        self.methodOptions.clicked.connect(self.ShowMethodMenu)
+        self.methodMenu.addAction('Economy', lambda: self.SetMethod('Economy'))
+        self.methodMenu.addAction('Randomised', lambda: self.SetMethod('Randomised'))
+        self.method.layout().addWidget(self.methodTitle)
+        self.method.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Preferred))
+        self.method.layout().addWidget(self.methodOptions)
+        self.widget.layout().addWidget(self.method)
+        self.CreateSection('modes', 'Randomised SVD Modes', 199, 0)
         self.CreateSection('truncation', 'Singular Vector Truncation', self.settings['components']['truncation']['max'], 0)
 
         self.widget.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Expanding))
@@ -39,6 +84,8 @@ class SVD(Composition):
             d['U'] = self.U
             d['VT'] = self.VT
             d['trajectory'] = self.data # list of x, y tuples
+            d['pseudoInverse'] = self.PseudoInverse()
+            d['prediction'] = self.Prediction()
             return d
 
         self.streams = {
@@ -49,18 +96,148 @@ class SVD(Composition):
                 'ylabel02': r'$\Delta~$Beam Centre (mm)',
                 'plottype': 'SVD',
             }),
+            'loop': lambda **kwargs: {
+                'xlabel': 'Iteration',
+                'ylabel': 'RMS Beam Centre',
+                'xunits': '',
+                'yunits': 'mm',
+                'plottype': 'plot',
+                'xlim': (0, max(len(self.loopHistory) - 1, 1)),
+                'ylim': (0, max(np.nanmax(self.loopHistory[:, 0], initial = 0), self.settings['loopTolerance']) * 1.1),
+                'data': self.loopHistory[:, 0],
+                'correctorStrength': self.loopHistory[:, 1],
+            },
         }
         # override in socket acceptable types
         self.inSocket.socket.acceptableTypes = ['Orbit Response']
         self.ToggleStyling(active = False)
 
     def PerformSVD(self):
-        '''Returns just singular values, but all data can be easily accessed.'''
-        data = shared.entities[next(iter(self.linksIn))].streams['default']()['data']
-        if data.shape != (0,):
-            self.U, self.s, self.VT = svd(shared.entities[next(iter(self.linksIn))].streams['default']()['data'])
+        '''Returns just singular values, but all data can be easily accessed.\n
+        Rows and columns of the ORM that are structurally zero (upstream BPMs, downstream correctors) are skipped by the decomposition.\n
+        The decomposition is cached and only recomputed when the version of the upstream ORM changes.
+        Columns that are not measured yet count as zero, and columns measured or rewritten since the last call are folded in
+        with rank one updates, so the singular values follow a running measurement without decomposing the whole ORM again.'''
+        stream = shared.entities[next(iter(self.linksIn))].streams['default']()
+        columnVersions = np.array(stream.get('columnVersions', np.empty((0,))))  # copied before the data, so no write is missed
+        data = stream['data']
+        version = stream.get('version')
+        if version is not None:
+            version = (*version, self.settings['method'], self.settings['components']['modes']['value'])
+            if version == self.SVDVersion:
+                return
+        if data.shape == (0,):
+            return
+        causalMask = stream.get('causalMask', np.empty((0, 0)))
+        if causalMask.shape != data.shape:
+            causalMask = np.ones(data.shape, dtype = bool)
+        measured = np.array(stream.get('mask', np.empty((0,))), dtype = bool)
+        if measured.shape != data.shape[1:]:
+            measured = ~np.isnan(data).any(axis = 0)
+        changed = np.flatnonzero(measured & (columnVersions != self.columnVersions)) if columnVersions.shape == self.columnVersions.shape else None
+        incremental = (
+            self.settings['method'] == 'Economy'
+            and version is not None and self.SVDVersion is not None
+            and version[0] == self.SVDVersion[0] and version[2:] == self.SVDVersion[2:] # same ORM buffer and settings
+            and changed is not None and len(changed) <= len(measured) // 2 # otherwise a full decomposition is cheaper
+        )
+        if incremental:
+            for column in changed:
+                self.U, self.s, self.VT = ReplaceColumn(self.U, self.s, self.VT, column, np.where(causalMask[:, column], data[:, column], 0))
+        else:
+            rank = self.settings['components']['modes']['value'] if self.settings['method'] == 'Randomised' else None
+            self.U, self.s, self.VT = CausalSVD(np.where(measured, data, 0), causalMask & measured, rank)
+        # every truncation level is precomputed, so moving the truncation slider needs no further linear algebra.
+        self.pseudoInverses = PseudoInverseLadder(self.U, self.s, self.VT)
+        self.SVDVersion = version
+        self.columnVersions = columnVersions
+        if len(self.s) != self.settings['components']['truncation']['max'] and len(self.s) > 0:
+            # the number of modes follows the measured columns, so the slider range does too; a slider at its maximum keeps all modes.
+            atMaximum = self.settings['components']['truncation']['value'] >= self.settings['components']['truncation']['max']
+            self.settings['components']['truncation']['max'] = len(self.s)
+            if atMaximum:
+                self.settings['components']['truncation']['value'] = len(self.s)
+            self.truncationAmount.SetMaximum(True)
+
+    def SolveOrbits(self):
+        '''Solves the corrector changes (mrad) that cancel every orbit in a file of BPM readings (orbits x BPMs, in mm), in the BPM order of the linked ORM.\n
+        Corrections are found for the current truncation over a sweep of Tikhonov strengths and saved, with their predicted residual orbits, to the datadump folder.'''
+        if len(self.linksIn) == 0:
+            return
+        self.PerformSVD()
+        if len(self.s) == 0:
+            shared.workspace.assistant.PushMessage('The linked orbit response has not been measured yet.', 'Error')
+            return
+        path, _ = QFileDialog.getOpenFileName(None, 'Load BPM Orbits', os.path.join(shared.cwd, 'datadump'), 'Orbits (*.npy *.csv *.parquet)')
+        if not path:
+            return
+        if path.endswith('.npy'):
+            orbits = np.load(path)
+        elif path.endswith('.csv'):
+            orbits = np.loadtxt(path, delimiter = ',', ndmin = 2)
+        else:
+            orbits = pd.read_parquet(path).to_numpy()
+        numBPMs = self.U.shape[0]
+        if orbits.shape[-1] != numBPMs:
+            if orbits.shape[0] != numBPMs:
+                shared.workspace.assistant.PushMessage(f'Orbits must have one reading for each of the {numBPMs} BPMs.', 'Error')
+                return
+            orbits = orbits.T
+        # no regularisation, then strengths spanning six decades below the largest squared singular value
+        regularisation = np.concatenate([[0], self.s[0] ** 2 * np.logspace(-6, 0, 13)])
+        truncation = min(self.settings['components']['truncation']['value'], len(self.s))
+        corrections = SolveCorrections(self.U, self.s, self.VT, orbits, regularisation, truncation)
+        residuals = orbits + corrections @ ((self.U * self.s) @ self.VT).T
+        timestamp = datetime.now()
+        os.makedirs(os.path.join(shared.cwd, 'datadump'), exist_ok = True)
+        np.savez(
+            os.path.join(shared.cwd, 'datadump', f'{self.name} corrections ({timestamp.strftime('%Y-%m-%d')} at {timestamp.strftime('%H-%M-%S')}).npz'),
+            corrections = corrections,
+            regularisation = regularisation,
+            truncation = truncation,
+            residualRMS = np.sqrt(np.mean(residuals ** 2, axis = 2)),
+            correctorRMS = np.sqrt(np.mean(corrections ** 2, axis = 2)),
+        )
+        shared.workspace.assistant.PushMessage(f'Solved {len(orbits)} orbits for {len(regularisation)} regularisation strengths.')
+
+    def PseudoInverse(self):
+        '''Returns the pseudo-inverse of the ORM (mrad / mm) truncated to the number of modes set by the truncation slider.'''
+        if len(self.pseudoInverses) == 0:
+            return np.zeros((0, 0))
+        # levels past the last mode kept above the tolerance are the same as that level.
+        truncation = min(max(self.settings['components']['truncation']['value'], 1), len(self.pseudoInverses))
+        return self.pseudoInverses[truncation - 1]
+
+    def Prediction(self):
+        '''Returns the corrected trajectory (mm) predicted for the current truncation, or NaNs if it has not been calculated.'''
+        truncation = self.settings['components']['truncation']['value']
+        if not 0 < truncation <= len(self.predictions):
+            return np.full(len(self.BPMs), np.nan)
+        return self.predictions[truncation - 1]
+
+    def SetMethod(self, method):
+        '''`method` = <Economy/Randomised>'''
+        self.settings['method'] = method
+        self.methodOptions.setText(f'{method:<14}\u25BC')
+
+    def ShowMethodMenu(self):
+        position = self.methodOptions.mapToGlobal(QPoint(0, self.methodOptions.height()))
+        self.methodMenu.popup(position)
 
     def Start(self):
+        self.LaunchAction()
+
+    def StartClosedLoop(self):
+        '''Iteratively corrects the trajectory of a private copy of the lattice with the truncated SVD, streaming the RMS trajectory and corrector strength of every iteration.'''
+        self.LaunchAction(
+            closedLoop = True,
+            truncation = self.settings['components']['truncation']['value'],
+            tolerance = self.settings['loopTolerance'],
+            maxIterations = self.settings['loopIterations'],
+            gain = self.settings['loopGain'],
+        )
+
+    def LaunchAction(self, **kwargs):
         # Sort the correctors and BPMs to produce a proper ORM (Index -> Alignment)
         if len(self.linksIn) == 0:
             return
@@ -77,18 +254,51 @@ class SVD(Composition):
             self.PerformSVD()
             self.offlineAction.correctors = self.correctors
             self.offlineAction.BPMs = self.BPMs
-            self.offlineAction.lattice = deepcopy(shared.lattice)
+            # the resident simulation server already holds the lattice and is only sent the elements changed since the last run,
+            # so the action goes without a copy of its own unless the server is still starting.
+            server = SyncServer(shared.lattice)
+            self.offlineAction.lattice = deepcopy(shared.lattice) if server is None else None
             self.offlineAction.U = self.U
             self.offlineAction.s = self.s
             self.offlineAction.VT = self.VT
             if not self.offlineAction.CheckForValidInputs():
                 return
+            # there is nothing to decompose (and no prediction to share) until the ORM has been measured.
+            if len(self.s) == 0:
+                shared.workspace.assistant.PushMessage('The linked orbit response has not been measured yet.', 'Error')
+                return
+            # report how often the server's tracking cache has saved a pass, so its size can be tuned.
+            statistics = CacheStatistics() if server is not None else None
+            if statistics is not None and statistics['hits'] + statistics['diskHits'] + statistics['misses'] > 0:
+                shared.workspace.assistant.PushMessage(
+                    f'Tracking cache hit rate {statistics['hitRate']:.0%} ({statistics['entries']} results, {statistics['bytes'] / 2 ** 20:.1f} MB held).'
+                )
+            # each run shares fresh arrays, so the previous run's are removed rather than left behind in shared memory.
+            if self.ID not in runningActions:
+                self.CleanUp()
             if not PerformAction(
                 self, 
                 np.empty((len(self.BPMs), 3)), # list of tuples where x0 = x, and x1...n are y values for different methods.
+                additionalDataArrays = {
+                    'predictions': np.empty((len(self.s), len(self.BPMs))),
+                    'loopHistory': np.empty((self.settings['loopIterations'] + 1, 2)),
+                    'loopCorrections': np.empty(len(self.correctors)),
+                },
+                beam = PooledBeam(10000, seed = self.settings['seed']),
+                server = server,
+                **kwargs,
             ):
                 shared.workspace.assistant.PushMessage('SVD trajectory calculation already running.', 'Error')
 
+    def CleanUp(self):
+        # remove the data from memory to stop it persisting after closing the application.
+        for name in ['data', 'predictions', 'loopHistory', 'loopCorrections']:
+            if hasattr(self, f'{name}SharedMemory'):
+                try:
+                    getattr(self, f'{name}SharedMemory').unlink()
+                except FileNotFoundError: # already removed by an earlier clean up.
+                    pass
+
     def AddLinkIn(self, ID, socket):
         # SVD only accepts ORM blocks so just collect those correctors and BPMs
         self.correctors = shared.entities[ID].correctors
@@ -1,14 +1,20 @@
 from PySide6.QtWidgets import QListWidget, QListWidgetItem, QWidget, QLabel, QMenu, QSpacerItem, QGraphicsProxyWidget, QSizePolicy, QPushButton, QVBoxLayout, QHBoxLayout
 from PySide6.QtCore import Qt, QPoint
 import numpy as np
+import os
 from copy import deepcopy
 from .draggable import Draggable
 from .. import shared
 from .. import style
 from ..components.slider import SliderComponent
 from ..actions.offline.orbitresponse import OrbitResponseAction
+from ..actions.offline.errorensemble import ErrorEnsembleAction
+from ..actions.online.orbitresponse import OrbitResponseAction as OnlineOrbitResponseAction, ExcitationPatterns
+from ..lattice.latticeutils import LatticeFingerprint
+from ..utils.linalg import CausalMask
+from ..utils.beams import PooledBeam
 from ..ui.runningcircle import RunningCircle
-from ..utils.multiprocessing import PerformAction, TogglePause, StopAction
+from ..utils.multiprocessing import PerformAction, TogglePause, StopAction, runningActions
 
 '''
 Orbit Response Block handles orbit response measurements off(on)line. It has two F sockets, one for Correctors, one for BPMs. 
@@ -19,21 +25,47 @@ to save the data, or for further processing in a pipeline.
 
 class OrbitResponse(Draggable):
     def __init__(self, parent, proxy: QGraphicsProxyWidget, **kwargs):
-        super().__init__(proxy, name = kwargs.pop('name', 'Orbit Response'), type = 'Orbit Response', size = kwargs.pop('size', [575, 440]), **kwargs)
+        super().__init__(proxy, name = kwargs.pop('name', 'Orbit Response'), type = 'Orbit Response', size = kwargs.pop('size', [575, 610]), **kwargs)
         self.parent = parent
         self.correctors = dict()
         self.BPMs = dict()
         self.ORM = np.empty((0,))
+        self.offlineEngines = ['Tracking', 'Analytic', 'Centroid', 'JAX', 'Ensemble']
+        self.onlineEngines = ['Hadamard', 'Random']
+        self.settings['engine'] = 'Tracking'
+        self.settings['order'] = 'Linear'
+        self.settings['coupled'] = False # also record the cross-plane response at every BPM.
+        self.settings['seed'] = 0 # seed of the pooled beam tracked by the offline model, shared with other blocks using the same seed.
+        self.numParticles = 10000 # particles in the pooled beam.
+        self.settings['aperture'] = 20 # half-width (mm) of the beam pipe the error ensemble is tracked through.
+        self.fitCoefficients = np.empty((0,))
+        self.fitErrors = np.empty((0,))
+        self.coupledORM = np.empty((0,))
+        self.causalMask = np.empty((0, 0), dtype = bool) # (BPM, corrector) pairs that are not structurally zero.
+        self.coupledRows = [] # lattice element names of the rows in each plane of the coupled ORM.
+        self.ORMMask = np.empty((0,), dtype = bool) # flags corrector columns of the ORM that have been measured and fitted.
+        self.ORMVersion = np.empty((0,), dtype = np.int64) # counts the writes to each corrector column of the ORM.
+        # Measured (corrector, BPM) pairs keyed on the lattice state and measurement settings, so new runs only measure what is missing.
+        self.ORMCache = dict()
+        self.maxCachedStates = 8
+        self.runLayout = None # cache key, (index, alignment, working point) of each corrector and (index, alignment) of each BPM in the last run.
         self.setStyleSheet('background: none')
         self.settings['components'] = {
             'current': dict(name = 'Current', value = .5, min = .01, max = 5, default = .5, units = 'mrad', type = SliderComponent),
             'steps': dict(name = 'Steps', value = 3, min = 3, max = 9, default = 3, units = 'mrad', valueType = int, type = SliderComponent),
-            'repeats': dict(name = 'Repeats', value = 5, min = 1, max = 20, default = 5, units = '', valueType = int, type = SliderComponent)
+            'repeats': dict(name = 'Repeats', value = 5, min = 1, max = 20, default = 5, units = '', valueType = int, type = SliderComponent),
+            'seeds': dict(name = 'Seeds', value = 100, min = 1, max = 1000, default = 100, units = '', valueType = int, type = SliderComponent),
         }
         self.active = False
         self.hovering = False
         self.startPos = None
         self.offlineAction = OrbitResponseAction()
+        self.ensembleAction = ErrorEnsembleAction()
+        self.onlineAction = OnlineOrbitResponseAction()
+        self.excitations = np.empty((0, 0)) # kick sign of each corrector in every online excitation pattern.
+        self.conditioning = np.empty((0,)) # condition number of the online excitation patterns measured so far.
+        self.transmission = np.empty((0,)) # surviving fraction of the beam for each seed of the error ensemble.
+        self.orbitStatistics = np.empty((4, 0)) # mean, 5th, 50th and 95th percentile orbit over the error ensemble.
         self.runningCircle = RunningCircle()
         # Define orbit response streams
         # All streams contain a 'default' entry for the de facto use case.
@@ -48,6 +80,19 @@ class OrbitResponse(Draggable):
                           [f'Measurement {r + 1}' for r in range(self.settings['components']['repeats']['value'])]],
                 # Full raw data
                 'data': self.data,
+            } if self.data.ndim == 4 else {
+                # error ensemble: the orbit of each seed
+                'ax': ['Seed'], # BPMs are the columns
+                'names': [[f'Seed {s + 1}' for s in range(self.data.shape[0])],
+                          [b.name for b in self.BPMs.values()]],
+                'data': self.data,
+            } if self.data.ndim == 2 else {
+                # simultaneous (online) excitation: the working point followed by each excitation pattern
+                'ax': ['BPM', 'Pattern'],
+                'names': [[b.name for b in self.BPMs.values()],
+                          ['Working Point'] + [f'Pattern {p + 1}' for p in range(self.data.shape[1] - 1)],
+                          [f'Measurement {r + 1}' for r in range(self.data.shape[2])]],
+                'data': self.data,
             },
             'default': lambda **kwargs: {
                 'xlabel': 'Corrector Number',
@@ -61,7 +106,71 @@ class OrbitResponse(Draggable):
                 'plottype': 'imshow',
                 'cmap': 'viridis',
                 'cmapLabel': r'$\Delta~$mm / mrad',
-                'data': self.ORM
+                'data': self.ORM,
+                'mask': self.ORMMask,
+                'causalMask': self.causalMask,
+                'version': self.Version(),
+                'columnVersions': self.ORMVersion,
+            },
+            'uncertainty': lambda **kwargs: {
+                'xlabel': 'Corrector Number',
+                'ylabel': 'BPM Number',
+                'xticks': np.arange(len(self.correctors)),
+                'yticks': np.arange(len(self.BPMs)),
+                'xticklabels': [c.name for c in self.correctors.values()],
+                'yticklabels': [b.name for b in self.BPMs.values()],
+                'xunits': '',
+                'yunits': '',
+                'plottype': 'imshow',
+                'cmap': 'viridis',
+                'cmapLabel': r'$\sigma~$mm / mrad',
+                'data': self.fitErrors[..., 1] if self.fitErrors.ndim == 3 else self.fitErrors
+            },
+            'coupled': lambda **kwargs: {
+                'xlabel': 'Corrector Number',
+                'ylabel': 'BPM Number',
+                'xticks': np.arange(len(self.correctors)),
+                'yticks': np.arange(2 * len(self.coupledRows)),
+                'xticklabels': [c.name for c in self.correctors.values()],
+                'yticklabels': [f'{name} ({plane})' for plane in ['x', 'y'] for name in self.coupledRows],
+                'xunits': '',
+                'yunits': '',
+                'plottype': 'imshow',
+                'cmap': 'viridis',
+                'cmapLabel': r'$\Delta~$mm / mrad',
+                'data': self.coupledORM,
+                'mask': self.ORMMask,
+            },
+            'conditioning': lambda **kwargs: {
+                'xlabel': 'Excitation Pattern',
+                'ylabel': r'$\log_{10}$ Condition Number',
+                'xunits': '',
+                'yunits': '',
+                'plottype': 'plot',
+                'xlim': (0, max(len(self.conditioning) - 1, 1)),
+                'ylim': (0, max(2, np.nanmax(np.log10(self.conditioning[np.isfinite(self.conditioning)]), initial = 0) + .5)),
+                'data': np.log10(np.where(np.isfinite(self.conditioning), self.conditioning, np.nan)),
+            },
+            'ensemble': lambda **kwargs: {
+                'xlabel': 'BPM Number',
+                'ylabel': 'Beam Center in BPM',
+                'xunits': '',
+                'yunits': 'mm',
+                'plottype': 'plot',
+                'legend': ['Mean', '5th Percentile', 'Median', '95th Percentile'],
+                'xlim': (0, max(len(self.BPMs) - 1, 1)),
+                'ylim': (np.nanmin(self.orbitStatistics, initial = 0) - .5, np.nanmax(self.orbitStatistics, initial = 0) + .5),
+                'data': self.orbitStatistics,
+            },
+            'transmission': lambda **kwargs: {
+                'xlabel': 'Seed',
+                'ylabel': 'Transmission',
+                'xunits': '',
+                'yunits': '',
+                'plottype': 'plot',
+                'xlim': (0, max(len(self.transmission) - 1, 1)),
+                'ylim': (0, 1.05),
+                'data': self.transmission,
             },
             'corrector': lambda **kwargs: {
                 'xlabel': f'Corrector Kick Angle',
@@ -127,12 +236,45 @@ class OrbitResponse(Draggable):
         self.order.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Preferred))
         self.order.layout().addWidget(self.orderOptions)
         self.widget.layout().addWidget(self.order)
+        # Engine used to generate the orbit response (offline)
+        self.engine = QWidget()
+        self.engine.setLayout(QHBoxLayout())
+        self.engine.layout().setContentsMargins(15, 10, 15, 0)
+        self.engineTitle = QLabel('Engine')
+        self.engineTitle.setStyleSheet(style.LabelStyle(fontColor = '#c4c4c4', padding = 0))
+        self.engineMenu = QMenu()
+        self.engineOptions = QPushButton(f'{self.settings['engine']:<14}\u25BC')
+        self.engineOptions.setStyleSheet(style.PushButtonStyle(color = '#1e1e1e', fontColor = '#c4c4c4', padding = 5, textAlign = 'right'))
+        self.engineOptions.setFixedWidth(115)
+        self.engineOptions.clicked.connect(self.ShowEngineMenu)
+        for engine in self.offlineEngines:
+            self.engineMenu.addAction(engine, lambda engine = engine: self.SetEngine(engine))
+        self.engine.layout().addWidget(self.engineTitle)
+        self.engine.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Preferred))
+        self.engine.layout().addWidget(self.engineOptions)
+        self.widget.layout().addWidget(self.engine)
+        # Record the cross-plane (coupled) response
+        self.coupled = QWidget()
+        self.coupled.setLayout(QHBoxLayout())
+        self.coupled.layout().setContentsMargins(15, 10, 15, 0)
+        self.coupledTitle = QLabel('Cross-plane response')
+        self.coupledTitle.setStyleSheet(style.LabelStyle(fontColor = '#c4c4c4', padding = 0))
+        self.coupledSwitch = QPushButton('On' if self.settings['coupled'] else 'Off')
+        self.coupledSwitch.clicked.connect(lambda: self.SetCoupled(not self.settings['coupled']))
+        self.coupledSwitch.setStyleSheet(style.PushButtonStyle(color = '#1e1e1e', fontColor = '#c4c4c4', padding = 5))
+        self.coupledSwitch.setFixedWidth(115)
+        self.coupled.layout().addWidget(self.coupledTitle)
+        self.coupled.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Preferred))
+        self.coupled.layout().addWidget(self.coupledSwitch)
+        self.widget.layout().addWidget(self.coupled)
         # # Corrector step current / kick
         self.CreateSection('current', 'Kick / step (mrad)', 1e6, 3)
         # Corrector steps
         self.CreateSection('steps', 'Steps', 3, 0)
         # BPM Repeats ...
         self.CreateSection('repeats', 'BPM measurements (0.2s wait)', 19, 0)
+        # Seeds of the error ensemble
+        self.CreateSection('seeds', 'Error ensemble seeds', 999, 0)
         # Some padding
         self.widget.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Expanding))
         self.AddSocket('corrector', 'F', 'Correctors', 175, acceptableTypes = ['Corrector'])
@@ -149,16 +291,38 @@ class OrbitResponse(Draggable):
         # Sort the correctors and BPMs to produce a proper ORM (Index -> Alignment)
         self.correctors = dict(sorted(sorted(self.correctors.items(), key = lambda item: item[1].settings['linkedElement'].Index), key = lambda item: item[1].settings['alignment']))
         self.BPMs = dict(sorted(sorted(self.BPMs.items(), key = lambda item: item[1].settings['linkedElement'].Index), key = lambda item: item[1].settings['alignment']))
-        if not self.online:
-            self.offlineAction.correctors = self.correctors
-            self.offlineAction.BPMs = self.BPMs
-            self.offlineAction.lattice = deepcopy(shared.lattice)
-            if not self.offlineAction.CheckForValidInputs():
+        if self.online:
+            self.StartOnline()
+        elif self.settings['engine'] == 'Ensemble':
+            self.StartEnsemble()
+        else:
+            if not self.PrepareAction(self.offlineAction):
                 return
             onlineText = 'online' if self.online else 'offline'
-            shared.workspace.assistant.PushMessage(f'Running orbit response measurement ({onlineText}).')
+            shared.workspace.assistant.PushMessage(f'Running orbit response measurement ({onlineText}, {self.settings['engine'].lower()}).')
             numBPMs = len(self.BPMs.keys())
             numCorrectors = len(self.correctors.keys())
+            order = 1 if self.settings['order'] == 'Linear' else 2
+            additionalDataArrays = self.ORMDataArrays(order + 1)
+            if self.settings['coupled']:
+                # x then y centres at every BPM lattice element, whatever the alignment of the BPMs linked to it.
+                self.coupledRows = [shared.lattice[idx].FamName for idx in sorted({b.settings['linkedElement'].Index for b in self.BPMs.values()})]
+                numRows = 2 * len(self.coupledRows)
+                additionalDataArrays['coupledData'] = np.empty((numRows, numCorrectors,
+                self.settings['components']['steps']['value'],
+                self.settings['components']['repeats']['value']))
+                additionalDataArrays['coupledORM'] = np.empty((numRows, numCorrectors))
+                additionalDataArrays['coupledFitCoefficients'] = np.empty((numRows, numCorrectors, order + 1))
+                additionalDataArrays['coupledFitErrors'] = np.empty((numRows, numCorrectors, order + 1))
+            newRun = self.ID not in runningActions # a paused run is resumed as it is.
+            columns, cachedColumns = None, None
+            if newRun:
+                self.CacheMeasuredColumns()
+                layout = self.RunLayout()
+                columns, cachedColumns = self.LookupCachedColumns(layout)
+                if cachedColumns:
+                    shared.workspace.assistant.PushMessage(f'Reusing {len(cachedColumns)} of {numCorrectors} orbit response columns from an earlier run.')
+                self.CleanUp() # the measured columns have been copied, so the previous run's shared arrays can be released.
             if not PerformAction(
                 self,
                 np.empty((numBPMs, numCorrectors,
@@ -166,12 +330,197 @@ class OrbitResponse(Draggable):
                 self.settings['components']['repeats']['value'])),
                 postProcessedDataName = 'ORM',
                 emptyPostProcessedDataArray = np.empty((numBPMs, numCorrectors)),
+                additionalDataArrays = additionalDataArrays,
                 numSteps = self.settings['components']['steps']['value'],
                 stepKick = self.settings['components']['current']['value'],
                 repeats = self.settings['components']['repeats']['value'],
+                engine = self.settings['engine'],
+                order = order,
+                numWorkers = os.cpu_count(),
+                beam = PooledBeam(self.numParticles, seed = self.settings['seed']) if self.settings['engine'] == 'Tracking' else None,
+                columns = columns,
+                cachedColumns = cachedColumns,
                 getRawData = False,
             ):
                 shared.workspace.assistant.PushMessage('Orbit response measurement already running.', 'Error')
+            elif newRun:
+                self.runLayout = layout
+
+    def StartEnsemble(self):
+        '''Tracks the beam through a lattice with a different sample of the alignment errors set on the linked PVs for each seed,
+        publishing the mean ORM, its spread across seeds (`uncertainty`), the orbit percentiles (`ensemble`) and the `transmission` of each seed.'''
+        # one entry per lattice element, taken from the PVs linked to it that have nonzero errors.
+        errors = dict()
+        for entity in shared.entities.values():
+            if 'linkedElement' not in entity.settings or 'errors' not in entity.settings.get('components', dict()):
+                continue
+            e = entity.settings['components']['errors']
+            if any(e[name] != 0 for name in ['pitch', 'yaw', 'roll']):
+                errors[entity.settings['linkedElement'].Index] = dict(
+                    index = entity.settings['linkedElement'].Index,
+                    sigma = [e[name] for name in ['pitch', 'yaw', 'roll']],
+                    fixed = [e[f'{name}Fixed'] for name in ['pitch', 'yaw', 'roll']],
+                )
+        if not errors:
+            shared.workspace.assistant.PushMessage('No alignment errors have been set on any linked PVs.', 'Error')
+            return
+        self.ensembleAction.errors = list(errors.values())
+        if not self.PrepareAction(self.ensembleAction):
+            return
+        numBPMs = len(self.BPMs.keys())
+        numCorrectors = len(self.correctors.keys())
+        numSeeds = self.settings['components']['seeds']['value']
+        numWorkers = min(os.cpu_count(), numSeeds)
+        shared.workspace.assistant.PushMessage(f'Running orbit response error ensemble ({numSeeds} seeds, {len(errors)} elements with errors).')
+        if self.ID not in runningActions:
+            self.CleanUp() # release the previous run's shared arrays before new ones are created.
+        if not PerformAction(
+            self,
+            np.empty((numSeeds, numBPMs)),
+            postProcessedDataName = 'ORM',
+            emptyPostProcessedDataArray = np.empty((numBPMs, numCorrectors)),
+            additionalDataArrays = self.ORMDataArrays(
+                2,
+                ORMMoments = np.empty((numWorkers, 2, numBPMs, numCorrectors)),
+                seedCounts = np.empty(numWorkers, dtype = np.int64),
+                sequences = np.empty(numWorkers, dtype = np.int64),
+                transmission = np.empty(numSeeds),
+                orbitStatistics = np.empty((4, numBPMs)),
+            ),
+            action = self.ensembleAction,
+            beam = PooledBeam(self.numParticles, seed = self.settings['seed']),
+            seed = self.settings['seed'],
+            aperture = self.settings['aperture'],
+            getRawData = False,
+        ):
+            shared.workspace.assistant.PushMessage('Orbit response measurement already running.', 'Error')
+        else:
+            self.runLayout = None # the ensemble ORM is not a measurement, so it is kept out of the offline cache.
+
+    def StartOnline(self):
+        '''Measures the ORM on the machine by driving every corrector at once with the excitation patterns of the selected engine.'''
+        if not self.PrepareAction(self.onlineAction):
+            return
+        numBPMs = len(self.BPMs.keys())
+        numCorrectors = len(self.correctors.keys())
+        if self.ID not in runningActions:
+            self.excitations = ExcitationPatterns(self.settings['engine'], numCorrectors)
+            self.runLayout = None # the shared arrays are replaced, so there is nothing to add to the offline cache.
+            self.CleanUp()
+        shared.workspace.assistant.PushMessage(f'Running orbit response measurement (online, {len(self.excitations)} {self.settings['engine'].lower()} patterns).')
+        if not PerformAction(
+            self,
+            np.empty((numBPMs, len(self.excitations) + 1, self.settings['components']['repeats']['value'])),
+            postProcessedDataName = 'ORM',
+            emptyPostProcessedDataArray = np.empty((numBPMs, numCorrectors)),
+            additionalDataArrays = self.ORMDataArrays(2, conditioning = np.empty(len(self.excitations))),
+            excitations = self.excitations,
+            stepKick = self.settings['components']['current']['value'],
+            repeats = self.settings['components']['repeats']['value'],
+            getRawData = False,
+        ):
+            shared.workspace.assistant.PushMessage('Orbit response measurement already running.', 'Error')
+
+    def PrepareAction(self, action):
+        '''Hands the sorted correctors and BPMs and a copy of the lattice to `action`, then resets the causal mask and the linked views for a new run.\n
+        Returns False if the inputs are not valid.'''
+        action.correctors = self.correctors
+        action.BPMs = self.BPMs
+        action.lattice = deepcopy(shared.lattice)
+        if not action.CheckForValidInputs():
+            return False
+        self.causalMask = CausalMask(
+            [b.settings['linkedElement'].Index for b in self.BPMs.values()],
+            [c.settings['linkedElement'].Index for c in self.correctors.values()],
+        )
+        # reset view blocks so they redraw the partially filled ORM from scratch.
+        for ID in self.linksOut:
+            if ID != 'free' and shared.entities[ID].type == 'View':
+                shared.entities[ID].firstDraw = True
+        return True
+
+    def ORMDataArrays(self, numCoefficients, **additionalDataArrays):
+        '''Returns the arrays every engine shares with its action, the fit coefficients and errors with `numCoefficients` per (BPM, corrector) pair
+        and the mask and write count of each corrector column, together with any engine specific `additionalDataArrays`.'''
+        numBPMs, numCorrectors = len(self.BPMs), len(self.correctors)
+        return {
+            'fitCoefficients': np.empty((numBPMs, numCorrectors, numCoefficients)),
+            'fitErrors': np.empty((numBPMs, numCorrectors, numCoefficients)),
+            'ORMMask': np.empty(numCorrectors, dtype = bool),
+            'ORMVersion': np.empty(numCorrectors, dtype = np.int64),
+            **additionalDataArrays,
+        }
+
+    def Version(self):
+        '''Returns a key that changes whenever the shared ORM buffer is replaced or any of its columns is rewritten.'''
+        if not hasattr(self, 'ORMSharedMemory'):
+            return None
+        return (self.ORMSharedMemory.name, int(self.ORMVersion.sum()))
+
+    def RunLayout(self):
+        '''Returns the cache key for the current lattice state, settings and beam, with the (index, alignment, working point) of each sorted corrector
+        and the (index, alignment) of each sorted BPM.\n
+        Correctors are kicked around their working point (`default`) rather than their lattice setting, so it is part of every cached column.'''
+        key = (
+            LatticeFingerprint(shared.lattice),
+            self.settings['engine'],
+            self.settings['order'],
+            self.settings['components']['current']['value'],
+            self.settings['components']['steps']['value'],
+            self.settings['components']['repeats']['value'],
+            self.settings['seed'],
+            self.numParticles,
+        )
+        BPMIdxs = sorted({int(b.settings['linkedElement'].Index) for b in self.BPMs.values()})
+        return dict(
+            key = key,
+            correctors = [(int(c.settings['linkedElement'].Index), c.settings['alignment'], float(c.settings['components']['value']['default'])) for c in self.correctors.values()],
+            BPMs = [(int(b.settings['linkedElement'].Index), b.settings['alignment']) for b in self.BPMs.values()],
+            # a coupled row reads the same pair as a BPM with that index and alignment, so both share cache entries.
+            coupledRows = [(idx, plane) for plane in ['Horizontal', 'Vertical'] for idx in BPMIdxs] if self.settings['coupled'] else None,
+        )
+
+    def CacheMeasuredColumns(self):
+        '''Stores every (corrector, BPM) pair of the columns completed in the last run.'''
+        if self.runLayout is None or self.ORMMask.shape != (len(self.runLayout['correctors']),):
+            return
+        cache = self.ORMCache.pop(self.runLayout['key'], dict())
+        self.ORMCache[self.runLayout['key']] = cache # most recently used states are kept at the end.
+        while len(self.ORMCache) > self.maxCachedStates:
+            self.ORMCache.pop(next(iter(self.ORMCache)))
+        sources = [(self.runLayout['BPMs'], self.data, self.fitCoefficients, self.fitErrors)]
+        if self.runLayout['coupledRows'] is not None:
+            sources.append((self.runLayout['coupledRows'], self.coupledData, self.coupledFitCoefficients, self.coupledFitErrors))
+        for col in np.flatnonzero(self.ORMMask):
+            c = self.runLayout['correctors'][col]
+            for BPMs, data, coefficients, errors in sources:
+                for row, b in enumerate(BPMs):
+                    cache[(c, b)] = dict(
+                        data = data[row, col].copy(),
+                        coefficients = coefficients[row, col].copy(),
+                        errors = errors[row, col].copy(),
+                    )
+        self.runLayout = None
+
+    def LookupCachedColumns(self, layout):
+        '''Returns the column indices that still need measuring, and a dict of the columns whose every BPM is cached.'''
+        cache = self.ORMCache.get(layout['key'], dict())
+        columns, cachedColumns = [], dict()
+        coupledRows = layout['coupledRows'] or []
+        for col, c in enumerate(layout['correctors']):
+            if all((c, b) in cache for b in layout['BPMs'] + coupledRows):
+                cachedColumns[col] = {
+                    k: np.array([cache[(c, b)][k] for b in layout['BPMs']])
+                    for k in ['data', 'coefficients', 'errors']
+                }
+                if coupledRows:
+                    cachedColumns[col].update({
+                        f'coupled{k.capitalize()}': np.array([cache[(c, b)][k] for b in coupledRows])
+                        for k in ['data', 'coefficients', 'errors']
+                    })
+            else:
+                columns.append(col)
+        return columns, cachedColumns
 
     def Pause(self):
         TogglePause(self, True)
@@ -182,8 +531,12 @@ class OrbitResponse(Draggable):
 
     def CleanUp(self):
         # remove the data from memory to stop it persisting after closing the application.
-        self.dataSharedMemory.unlink()
-        self.ORMSharedMemory.unlink()
+        for name in ['data', 'ORM', 'fitCoefficients', 'fitErrors', 'ORMMask', 'ORMVersion', 'coupledData', 'coupledORM', 'coupledFitCoefficients', 'coupledFitErrors', 'conditioning', 'ORMMoments', 'seedCounts', 'sequences', 'transmission', 'orbitStatistics']:
+            if hasattr(self, f'{name}SharedMemory'):
+                try:
+                    getattr(self, f'{name}SharedMemory').unlink()
+                except FileNotFoundError: # already removed by an earlier clean up.
+                    pass
 
     # def CreateSection(self, name, title, sliderSteps, floatdp, disableValue = False):
     #     housing = QWidget()
@@ -220,17 +573,39 @@ class OrbitResponse(Draggable):
         else:
             self.modeTitle.setText('Mode: <u><span style = "color: #3C9C29">Online</span></u>')
         self.online = not self.online
+        # offline engines simulate the response, online engines choose how the correctors are excited together.
+        engines = self.onlineEngines if self.online else self.offlineEngines
+        self.engineMenu.clear()
+        for engine in engines:
+            self.engineMenu.addAction(engine, lambda engine = engine: self.SetEngine(engine))
+        self.SetEngine(engines[0])
 
     def SetOrderLinear(self):
+        self.settings['order'] = 'Linear'
         self.orderOptions.setText('Linear        \u25BC')
     
     def SetOrderQuadratic(self):
+        self.settings['order'] = 'Quadratic'
         self.orderOptions.setText('Quadratic     \u25BC')
 
     def ShowMenu(self):
         position = self.orderOptions.mapToGlobal(QPoint(0, self.orderOptions.height()))
         self.orderMenu.popup(position)
 
+    def SetEngine(self, engine):
+        '''`engine` = <Tracking/Analytic/Centroid/JAX/Ensemble> offline or <Hadamard/Random> online'''
+        self.settings['engine'] = engine
+        self.engineOptions.setText(f'{engine:<14}\u25BC')
+
+    def SetCoupled(self, coupled: bool):
+        '''Also record the x and y response at every BPM lattice element, published in the `coupled` stream.'''
+        self.settings['coupled'] = coupled
+        self.coupledSwitch.setText('On' if coupled else 'Off')
+
+    def ShowEngineMenu(self):
+        position = self.engineOptions.mapToGlobal(QPoint(0, self.engineOptions.height()))
+        self.engineMenu.popup(position)
+
     def mousePressEvent(self, event):
         self.startPos = event.pos()
         if self.canDrag or (self.hoveringSocket and self.hoveringSocket.name != 'Output'):
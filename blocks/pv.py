@@ -10,6 +10,7 @@ from ..components import link
 from ..components import kickangle
 from ..components import errors
 from .socket import Socket
+from ..lattice.server import UpdateServer
 
 class PV(Draggable):
     def __init__(self, parent, proxy: QGraphicsProxyWidget, **kwargs):
@@ -22,6 +23,7 @@ class PV(Draggable):
             components = {
                 'value': dict(name = 'Slider', value = 0, min = 0, max = 100, default = 0, units = 'mrad', type = slider.SliderComponent),
                 'linkedLatticeElement': dict(name = 'Linked Lattice Element', type = link.LinkComponent),
+                'errors': dict(name = 'Alignment Errors', units = 'mrad', pitch = 0., yaw = 0., roll = 0., pitchFixed = False, yawFixed = False, rollFixed = False, type = errors.ErrorsComponent),
             },
             **kwargs
         )
@@ -81,6 +83,8 @@ class PV(Draggable):
                 shared.lattice[self.settings['linkedElement'].Index].K = func(slider.value())
             else:
                 shared.lattice[self.settings['linkedElement'].Index].K = override
+        # keep the resident simulation server in step with the slider.
+        UpdateServer(shared.lattice, [self.settings['linkedElement'].Index])
 
     def mouseReleaseEvent(self, event):
         # Store temporary values since Draggable overwrites them in its mouseReleaseEvent override.
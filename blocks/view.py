@@ -1,5 +1,5 @@
-from PySide6.QtWidgets import QWidget, QPushButton, QLabel, QSpacerItem, QGraphicsProxyWidget, QSizePolicy, QVBoxLayout, QHBoxLayout
-from PySide6.QtCore import Qt, QTimer
+from PySide6.QtWidgets import QWidget, QPushButton, QMenu, QLabel, QSpacerItem, QGraphicsProxyWidget, QSizePolicy, QVBoxLayout, QHBoxLayout
+from PySide6.QtCore import Qt, QTimer, QPoint
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
@@ -36,8 +36,10 @@ class View(Draggable):
         self.liveUpdateCheckTimeInMilliseconds = 1 / self.liveUpdateCheckFrequency * 1e3
         self.runningCircle = RunningCircle()
         self.firstDraw = True
+        self.settings['stream'] = 'default' # stream of the linked block to display.
         # Attrs relevant to plotting
         self.yline = None # 1d line plots
+        self.image = None # 2d image plots
         self.Push()
 
     def Push(self):
@@ -91,6 +93,13 @@ class View(Draggable):
         self.liveButton.clicked.connect(self.ToggleLiveUpdates)
         self.liveUpdateSection.layout().addWidget(self.liveButton)
         self.liveUpdateSection.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Preferred))
+        # stream selection
+        self.liveUpdateSection.layout().addWidget(QLabel('Stream'))
+        self.streamMenu = QMenu()
+        self.streamButton = QPushButton(f'{self.settings['stream'].capitalize():<14}\u25BC')
+        self.streamButton.setFixedSize(150, 35)
+        self.streamButton.clicked.connect(self.ShowStreamMenu)
+        self.liveUpdateSection.layout().addWidget(self.streamButton)
         self.widget.layout().addWidget(self.liveUpdateSection)
         self.widget.layout().addWidget(self.plot)
         self.widget.layout().addItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Expanding)) # for spacing
@@ -108,7 +117,7 @@ class View(Draggable):
             print('Stopping live updates')
             return
         if self.linksIn:
-            self.DrawCanvas('default')
+            self.DrawCanvas(self.settings['stream'])
             QTimer.singleShot(self.liveUpdateCheckTimeInMilliseconds, self.CheckData)
 
     def ToggleLiveUpdates(self):
@@ -117,6 +126,35 @@ class View(Draggable):
         if self.liveUpdatesEnabled:
             QTimer.singleShot(0, self.CheckData)
    
+    def ShowStreamMenu(self):
+        '''Lists the displayable streams of the linked block.'''
+        if not self.linksIn:
+            return
+        self.streamMenu.clear()
+        for name in shared.entities[next(iter(self.linksIn))].streams.keys():
+            if name != 'raw': # raw data is consumed by save blocks, not plotted.
+                self.streamMenu.addAction(name.capitalize(), lambda name = name: self.SetStream(name))
+        self.streamMenu.popup(self.streamButton.mapToGlobal(QPoint(0, self.streamButton.height())))
+
+    def SetStream(self, stream):
+        self.settings['stream'] = stream
+        self.streamButton.setText(f'{stream.capitalize():<14}\u25BC')
+        self.ResetFigure()
+        self.DrawCanvas(stream)
+
+    def ResetFigure(self):
+        '''Removes every artist of the previous stream, including the colorbar axes and any subplots, and starts again from a single empty axes.'''
+        self.figure.clear()
+        self.axes = self.figure.add_subplot(111)
+        self.axes.set_aspect('auto')
+        self.ClearCanvas()
+        self.ToggleSpines(self.axes, False)
+        # cached artists belonged to the cleared figure.
+        self.image, self.cb, self.yline = None, None, None
+        self.canvasHasBeenCleared = False
+        self.firstDraw = True
+        self.figure.canvas.draw_idle()
+
     def DrawCanvas(self, stream = 'default', **kwargs):
         if not self.linksIn:
             return
@@ -135,24 +173,40 @@ class View(Draggable):
                 self.axes.tick_params(axis='x', which='both', labelbottom = True, length = 5)
                 self.axes.tick_params(axis='y', which='both', labelleft = True, length = 5)
             if self.stream['plottype'] == 'imshow':
-                if 'norm' in self.stream.keys():
-                    im = self.axes.imshow(self.stream['data'], cmap = self.stream['cmap'], norm = TwoSlopeNorm(vcenter = self.stream['vcenter']))
+                data = self.stream['data']
+                if 'mask' in self.stream.keys() and self.stream['mask'].shape == data.shape[1:]:
+                    # grey out columns that are still pending so partially filled matrices can be inspected live.
+                    data = np.ma.masked_array(data, np.broadcast_to(~self.stream['mask'][None, :], data.shape))
+                if self.firstDraw or self.image is None or self.image.get_array().shape != data.shape:
+                    if self.image is not None:
+                        self.image.remove()
+                        self.cb.remove()
+                    cmap = plt.get_cmap(self.stream['cmap']).copy()
+                    cmap.set_bad('#5c5c5c')
+                    if 'norm' in self.stream.keys():
+                        im = self.axes.imshow(data, cmap = cmap, norm = TwoSlopeNorm(vcenter = self.stream['vcenter']))
+                    else:
+                        im = self.axes.imshow(data, cmap = cmap)
+                    self.image = im
+                    divider = make_axes_locatable(self.axes)
+                    cax = divider.append_axes("right", size = "5%", pad = 0.075)
+                    self.cb = self.figure.colorbar(im, cax = cax, ax = self.axes)
+                    self.cb.set_label(self.stream['cmapLabel'], rotation = 270, fontsize = self.fontsize, labelpad = 20, color = '#c4c4c4')
+                    self.cb.ax.tick_params(colors = '#c4c4c4', labelsize = self.fontsize)
+                    for spine in self.cb.ax.spines.values():
+                        spine.set_edgecolor("#c4c4c4")
+                        spine.set_linewidth(1)
+                    self.axes.set_xticks(self.stream['xticks'])
+                    self.axes.set_xticklabels(self.stream['xticklabels'], rotation = 90)
+                    self.axes.set_yticks(self.stream['yticks'])
+                    self.axes.set_yticklabels(self.stream['yticklabels'])
+                    self.axes.set_aspect('auto')
+                    self.figure.tight_layout()
+                    self.firstDraw = False
                 else:
-                    im = self.axes.imshow(self.stream['data'], cmap = self.stream['cmap'])
-                divider = make_axes_locatable(self.axes)
-                cax = divider.append_axes("right", size = "5%", pad = 0.075)
-                self.cb = self.figure.colorbar(im, cax = cax, ax = self.axes)
-                self.cb.set_label(self.stream['cmapLabel'], rotation = 270, fontsize = self.fontsize, labelpad = 20, color = '#c4c4c4')
-                self.cb.ax.tick_params(colors = '#c4c4c4', labelsize = self.fontsize)
-                for spine in self.cb.ax.spines.values():
-                    spine.set_edgecolor("#c4c4c4")
-                    spine.set_linewidth(1)
-                self.axes.set_xticks(self.stream['xticks'])
-                self.axes.set_xticklabels(self.stream['xticklabels'], rotation = 90)
-                self.axes.set_yticks(self.stream['yticks'])
-                self.axes.set_yticklabels(self.stream['yticklabels'])
-                self.axes.set_aspect('auto')
-                self.figure.tight_layout()
+                    # only the pixel values and colour limits change between live updates.
+                    self.image.set_data(data)
+                    self.image.autoscale()
                 # testing for now ... this draw call leads to terrible performance live, need to replace with blitting.
                 self.figure.canvas.draw() # I should look into whether blitting can be used to speed up 2D plots.
             # line plots
@@ -180,10 +234,36 @@ class View(Draggable):
                         else:
                             self.ln.set_ydata(self.stream['data'])
                         self.bm.update()
+                elif dimension == 2:
+                        # one line per row, e.g. the mean and percentile orbits of an error ensemble.
+                        if self.firstDraw:
+                            self.axes.tick_params(axis='x', which='both', labelbottom = True, length = 5)
+                            self.axes.tick_params(axis='y', which='both', labelleft = True, length = 5)
+                            xunits = f' ({self.stream['xunits']})' if self.stream['xunits'] != '' else ''
+                            self.axes.set_xlabel(f'{self.stream['xlabel']}{xunits}', fontsize = self.fontsize, labelpad = 10, color = '#c4c4c4')
+                            yunits = f' ({self.stream['yunits']})' if self.stream['yunits'] != '' else ''
+                            self.axes.set_ylabel(f'{self.stream['ylabel']}{yunits}', fontsize = self.fontsize, labelpad = 10, color = '#c4c4c4')
+                            self.x = np.array(list(range(0, dataShape[1])))
+                            self.lns = [self.axes.plot(self.x, row, animated = True, label = label)[0] for row, label in zip(self.stream['data'], self.stream.get('legend', [None] * dataShape[0]))]
+                            self.axes.set_xlim(self.stream['xlim'])
+                            self.axes.set_ylim(self.stream['ylim'])
+                            if 'legend' in self.stream:
+                                self.axes.legend(fontsize = self.fontsize)
+                            self.axes.grid(alpha = .35)
+                            self.figure.tight_layout()
+                            self.firstDraw = False
+                            self.figure.canvas.draw()
+                            self.bm = BlitManager(self.figure.canvas, self.lns)
+                        else:
+                            for ln, row in zip(self.lns, self.stream['data']):
+                                ln.set_ydata(row)
+                        self.bm.update()
             elif self.stream['plottype'] == 'SVD':
-                if self.firstDraw:
+                # the scree plot is drawn while the orbit response is still being measured, before any trajectory exists.
+                trajectory = self.stream['trajectory'] if np.ndim(self.stream['trajectory']) == 2 else np.full((len(self.stream['prediction']), 2), np.nan)
+                if self.firstDraw or len(self.scree) != len(self.stream['data']):
                     print('View block is redrawing!')
-                    if np.isnan(self.stream['trajectory'][:, 0]).any():
+                    if len(self.stream['data']) == 0:
                         return
                     self.figure.clear()
                     # scree plot
@@ -199,22 +279,31 @@ class View(Draggable):
                     # plotting of the data
                     # scree plot
                     self.scree = self.axes01.bar(self.stream['xticks01'], self.stream['data'])
+                    self.screeHeights = np.array(self.stream['data'])
                     self.axes01.set_xticks(self.stream['xticks01'])
                     self.axes01.set_xticklabels(self.stream['xticklabels01'])
                     self.axes01.set_xlabel(self.stream['xlabel01'], color = '#c4c4c4', size = self.fontsize)
                     self.axes01.set_ylabel(self.stream['ylabel01'], color = '#c4c4c4', size = self.fontsize)
                     # draw truncation line
-                    self.axes01.axvline(entityIn.settings['components']['truncation']['value'] - 1 + .5, ls = '--', color = "#e3bd23", label = 'Truncation Boundary')
+                    self.truncationLine = self.axes01.axvline(entityIn.settings['components']['truncation']['value'] - 1 + .5, ls = '--', color = "#e3bd23", label = 'Truncation Boundary')
                     self.axes01.legend(loc = 'upper right')
                     self.axes02.axhline(y = 0, color = 'white', lw = 2, alpha = .35)
                     # trajectory plot
                     self.trajectory, = self.axes02.plot(
-                        self.stream['trajectory'][:, 0],
-                        self.stream['trajectory'][:, 1],
+                        trajectory[:, 0],
+                        trajectory[:, 1],
                         marker = 'o',
                         markersize = 5,
                         label = 'PyAT Nominal'
                     )
+                    # trajectory predicted after correcting with the selected truncation
+                    self.prediction, = self.axes02.plot(
+                        trajectory[:, 0],
+                        self.stream['prediction'],
+                        marker = 'o',
+                        markersize = 5,
+                        label = 'SVD Corrected',
+                    )
                     self.axes02.set_xlabel(self.stream['xlabel02'], color = '#c4c4c4', size = self.fontsize)
                     self.axes02.set_ylabel(self.stream['ylabel02'], color = '#c4c4c4', size = self.fontsize)
                     self.axes02.grid(alpha = .35)
@@ -224,13 +313,27 @@ class View(Draggable):
                     self.figure.tight_layout()
                     self.firstDraw = False
                     self.figure.canvas.draw_idle()
-                    self.bm = BlitManager(self.figure.canvas, [self.trajectory, ])
+                    self.bm = BlitManager(self.figure.canvas, [self.trajectory, self.prediction, self.truncationLine])
                 else:
-                    self.trajectory.set_xdata(self.stream['trajectory'][:, 0])
-                    self.trajectory.set_ydata(self.stream['trajectory'][:, 1])
+                    # singular values refined by a running measurement only move the bars, so the axes are kept.
+                    if not np.array_equal(self.screeHeights, self.stream['data']):
+                        for bar, height in zip(self.scree, self.stream['data']):
+                            bar.set_height(height)
+                        self.screeHeights = np.array(self.stream['data'])
+                        self.axes01.relim()
+                        self.axes01.autoscale_view()
+                        self.figure.canvas.draw_idle()
+                    self.trajectory.set_xdata(trajectory[:, 0])
+                    self.trajectory.set_ydata(trajectory[:, 1])
+                    # scrubbing the truncation slider only swaps in a precomputed prediction, so it is blitted without a redraw.
+                    self.prediction.set_xdata(trajectory[:, 0])
+                    self.prediction.set_ydata(self.stream['prediction'])
+                    truncationBoundary = entityIn.settings['components']['truncation']['value'] - 1 + .5
+                    self.truncationLine.set_xdata([truncationBoundary, truncationBoundary])
                 self.bm.update()
-        except:
-            pass
+        except (KeyError, IndexError, ValueError) as e:
+            # a stream that is missing a field or is still being filled is skipped until the next update.
+            print(f'View could not draw the {stream} stream: {e}')
 
     def ClearCanvas(self):
         self.axes.tick_params(axis='x', which='both', labelbottom = False, length = 0)
@@ -254,6 +357,8 @@ class View(Draggable):
         if self.linksIn:
             super().RemoveLinkIn(next(iter(self.linksIn)))
         super().AddLinkIn(ID, socket)
+        self.settings['stream'] = 'default'
+        self.streamButton.setText(f'{'Default':<14}\u25BC')
         self.title.setText('View (Connected)')
 
     def UpdateColors(self):
@@ -268,4 +373,5 @@ class View(Draggable):
         else:
             self.widget.setStyleSheet(style.WidgetStyle(color = '#2e2e2e', borderRadius = 12))
             self.title.setStyleSheet(style.LabelStyle(padding = 0, fontSize = 18, fontColor = '#c4c4c4'))
-            self.liveButton.setStyleSheet(style.PushButtonStyle(color = '#3e3e3e', hoverColor = '#4e4e4e', fontColor = '#c4c4c4'))
\ No newline at end of file
+            self.liveButton.setStyleSheet(style.PushButtonStyle(color = '#3e3e3e', hoverColor = '#4e4e4e', fontColor = '#c4c4c4'))
+            self.streamButton.setStyleSheet(style.PushButtonStyle(color = '#3e3e3e', hoverColor = '#4e4e4e', fontColor = '#c4c4c4', textAlign = 'right'))
\ No newline at end of file
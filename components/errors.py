@@ -12,6 +12,11 @@ class ErrorsComponent(QWidget):
         super().__init__()
         self.pv = pv
         self.component = component
+        # values (mrad) and modes persist in the component settings, so they are saved and can be sampled by an error ensemble.
+        self.settings = self.pv.settings['components'][self.component]
+        for name in ['pitch', 'yaw', 'roll']:
+            self.settings.setdefault(name, 0.)
+            self.settings.setdefault(f'{name}Fixed', False)
         self.setLayout(QVBoxLayout())
         self.layout().setContentsMargins(5, 0, 0, 5)
         self.layout().setSpacing(10)
@@ -19,7 +24,6 @@ class ErrorsComponent(QWidget):
         self.description = QLabel('Normal-distributed angle errors, or fixed offsets.')
         self.layout().addWidget(self.description)
         # Pitch
-        self.pitchFixed = False
         self.pitchRow = QWidget()
         self.pitchRow.setFixedHeight(35)
         self.pitchRow.setLayout(QHBoxLayout())
@@ -29,7 +33,7 @@ class ErrorsComponent(QWidget):
         self.pitchLabel.setFixedWidth(135)
         self.pitchRow.layout().addWidget(self.pitchLabel, alignment = Qt.AlignLeft)
         # Pitch in mrad
-        self.pitch = QLineEdit(f'{0:.1f}')
+        self.pitch = QLineEdit(f'{self.settings['pitch']:.1f}')
         self.pitch.returnPressed.connect(lambda: self.SetOffset('Pitch'))
         self.pitch.setAlignment(Qt.AlignCenter)
         self.pitch.setFixedWidth(65)
@@ -42,7 +46,6 @@ class ErrorsComponent(QWidget):
         self.pitchFix.setFixedWidth(150)
         self.pitchRow.layout().addWidget(self.pitchFix)
         # Yaw
-        self.yawFixed = False
         self.yawRow = QWidget()
         self.yawRow.setFixedHeight(35)
         self.yawRow.setLayout(QHBoxLayout())
@@ -52,7 +55,7 @@ class ErrorsComponent(QWidget):
         self.yawLabel.setFixedWidth(135)
         self.yawRow.layout().addWidget(self.yawLabel, alignment = Qt.AlignLeft)
         # Yaw in mrad
-        self.yaw = QLineEdit(f'{0:.1f}')
+        self.yaw = QLineEdit(f'{self.settings['yaw']:.1f}')
         self.yaw.returnPressed.connect(lambda: self.SetOffset('Yaw'))
         self.yaw.setAlignment(Qt.AlignCenter)
         self.yaw.setFixedWidth(65)
@@ -64,7 +67,6 @@ class ErrorsComponent(QWidget):
         self.yawFix.setFixedWidth(150)
         self.yawRow.layout().addWidget(self.yawFix)
         # Roll
-        self.rollFixed = False
         self.rollRow = QWidget()
         self.rollRow.setFixedHeight(35)
         self.rollRow.setLayout(QHBoxLayout())
@@ -74,7 +76,7 @@ class ErrorsComponent(QWidget):
         self.rollLabel.setFixedWidth(135)
         self.rollRow.layout().addWidget(self.rollLabel, alignment = Qt.AlignLeft)
         # Roll in mrad
-        self.roll = QLineEdit(f'{0:.1f}')
+        self.roll = QLineEdit(f'{self.settings['roll']:.1f}')
         self.roll.returnPressed.connect(lambda: self.SetOffset('Roll'))
         self.roll.setAlignment(Qt.AlignCenter)
         self.roll.setFixedWidth(65)
@@ -89,13 +91,18 @@ class ErrorsComponent(QWidget):
         self.layout().addWidget(self.pitchRow)
         self.layout().addWidget(self.yawRow)
         self.layout().addWidget(self.rollRow)
+        # Restore fixed modes from the settings
+        for name, label, fix in [('Pitch', self.pitchLabel, self.pitchFix), ('Yaw', self.yawLabel, self.yawFix), ('Roll', self.rollLabel, self.rollFix)]:
+            if self.settings[f'{name.lower()}Fixed']:
+                label.setText(f'{name} (Fixed):')
+                fix.setText('Switch to Random')
         # Update colors
         self.UpdateColors()
 
     def SwitchMode(self, nm):
         if nm == 'Pitch':
-            self.pitchFixed = not self.pitchFixed
-            if self.pitchFixed:
+            self.settings['pitchFixed'] = not self.settings['pitchFixed']
+            if self.settings['pitchFixed']:
                 self.pitchLabel.setText('Pitch (Fixed):')
                 self.pitchFix.setText('Switch to Random')
             else:
@@ -103,9 +110,10 @@ class ErrorsComponent(QWidget):
                 self.pitchFix.setText('Switch to Fixed')
                 if float(self.pitch.text()) < 0:
                     self.pitch.setText(f'{0:.1f}')
+                    self.settings['pitch'] = 0.
         elif nm == 'Yaw':
-            self.yawFixed = not self.yawFixed
-            if self.yawFixed:
+            self.settings['yawFixed'] = not self.settings['yawFixed']
+            if self.settings['yawFixed']:
                 self.yawLabel.setText('Yaw (Fixed):')
                 self.yawFix.setText('Switch to Random')
             else:
@@ -113,9 +121,10 @@ class ErrorsComponent(QWidget):
                 self.yawFix.setText('Switch to Fixed')
                 if float(self.yaw.text()) < 0:
                     self.yaw.setText(f'{0:.1f}')
+                    self.settings['yaw'] = 0.
         else:
-            self.rollFixed = not self.rollFixed
-            if self.rollFixed:
+            self.settings['rollFixed'] = not self.settings['rollFixed']
+            if self.settings['rollFixed']:
                 self.rollLabel.setText('Roll (Fixed):')
                 self.rollFix.setText('Switch to Random')
             else:
@@ -123,23 +132,27 @@ class ErrorsComponent(QWidget):
                 self.rollFix.setText('Switch to Fixed')
                 if float(self.roll.text()) < 0:
                     self.roll.setText(f'{0:.1f}')
+                    self.settings['roll'] = 0.
 
     def SetOffset(self, name):
         if name == 'Pitch':
             self.pitch.clearFocus()
             v = float(self.pitch.text())
-            v = 0 if not self.pitchFixed and v < 0 else v
+            v = 0 if not self.settings['pitchFixed'] and v < 0 else v
             self.pitch.setText(f'{v:.1f}')
+            self.settings['pitch'] = v
         elif name == 'Yaw':
             self.yaw.clearFocus()
             v = float(self.yaw.text())
-            v = 0 if not self.yawFixed and v < 0 else v
+            v = 0 if not self.settings['yawFixed'] and v < 0 else v
             self.yaw.setText(f'{v:.1f}')
+            self.settings['yaw'] = v
         else:
             self.roll.clearFocus()
             v = float(self.roll.text())
-            v = 0 if not self.rollFixed and v < 0 else v
+            v = 0 if not self.settings['rollFixed'] and v < 0 else v
             self.roll.setText(f'{v:.1f}')
+            self.settings['roll'] = v
 
     def UpdateColors(self):
         if shared.lightModeOn:
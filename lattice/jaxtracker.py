@@ -0,0 +1,85 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+from at import elements as emnts
+
+'''Differentiable linear tracking of the transverse beam centroid with JAX.'''
+
+jax.config.update('jax_enable_x64', True) # match the double precision of PyAT.
+
+def PlaneMatrices(k, length):
+    '''2 x 2 transfer matrices (... x 2 x 2) of a plane with focusing strength `k` (1 / m^2) over `length`, for focusing, defocusing and field free elements alike.'''
+    focusing, defocusing = k > 1e-12, k < -1e-12
+    # the square root is kept away from zero so the unused branches stay differentiable.
+    sq = jnp.sqrt(jnp.where(focusing | defocusing, jnp.abs(k), 1))
+    phi = sq * length
+    C = jnp.where(focusing, jnp.cos(phi), jnp.where(defocusing, jnp.cosh(phi), 1))
+    S = jnp.where(focusing, jnp.sin(phi) / sq, jnp.where(defocusing, jnp.sinh(phi) / sq, length))
+    Cp = jnp.where(focusing, -sq * jnp.sin(phi), jnp.where(defocusing, sq * jnp.sinh(phi), 0))
+    return jnp.stack([jnp.stack([C, S], -1), jnp.stack([Cp, C], -1)], -2)
+
+class JAXTracker:
+    '''Linear model of a PyAT lattice of drifts, quadrupoles, dipoles, correctors and markers, as a jit compiled JAX function.\n
+    Every element is an affine map of (x, px, y, py), held as a 5 x 5 matrix whose last column is the corrector kick.
+    Elements of other types are treated as drifts of their length. Tracking is a pure function of the `parameters` dict,
+    so it can be vmapped over many parameter sets and differentiated with jacfwd (e.g. for the ORM or the gradient of an objective).'''
+    def __init__(self, lattice):
+        numElements = len(lattice)
+        self.parameters = {
+            'length': np.array([e.Length for e in lattice], dtype = float),
+            'K': np.zeros(numElements), # quadrupole gradient (1 / m^2)
+            'bendingAngle': np.zeros(numElements),
+            'entranceAngle': np.zeros(numElements),
+            'exitAngle': np.zeros(numElements),
+            'kick': np.zeros((numElements, 2)), # corrector kick angles (rad)
+        }
+        for idx, e in enumerate(lattice):
+            if isinstance(e, (emnts.Quadrupole, emnts.Dipole)):
+                self.parameters['K'][idx] = e.PolynomB[1] if len(e.PolynomB) > 1 else 0
+            if isinstance(e, emnts.Dipole):
+                self.parameters['bendingAngle'][idx] = e.BendingAngle
+                self.parameters['entranceAngle'][idx] = getattr(e, 'EntranceAngle', 0)
+                self.parameters['exitAngle'][idx] = getattr(e, 'ExitAngle', 0)
+            elif isinstance(e, emnts.Corrector):
+                self.parameters['kick'][idx] = e.KickAngle
+        self.parameters = {k: jnp.asarray(v) for k, v in self.parameters.items()}
+        self.Track = jax.jit(self.Track)
+        self.OrbitResponse = jax.jit(self.OrbitResponse, static_argnums = (1, 2))
+
+    def Matrices(self, parameters):
+        '''Affine 5 x 5 matrix of every element (numElements x 5 x 5).'''
+        length, K, angle = parameters['length'], parameters['K'], parameters['bendingAngle']
+        h = jnp.where(length > 0, angle / jnp.where(length > 0, length, 1), 0) # curvature of dipoles
+        x, y = PlaneMatrices(h ** 2 + K, length), PlaneMatrices(-K, length)
+        # for a positive edge angle the dipole edges defocus horizontally and focus vertically by h tan(angle).
+        entrance, exit = h * jnp.tan(parameters['entranceAngle']), h * jnp.tan(parameters['exitAngle'])
+        edge = lambda e, sign: jnp.stack([jnp.stack([jnp.ones_like(e), jnp.zeros_like(e)], -1), jnp.stack([sign * e, jnp.ones_like(e)], -1)], -2)
+        x = edge(exit, 1) @ x @ edge(entrance, 1)
+        y = edge(exit, -1) @ y @ edge(entrance, -1)
+        M = jnp.zeros((len(length), 5, 5)).at[:, 4, 4].set(1)
+        M = M.at[:, :2, :2].set(x).at[:, 2:4, 2:4].set(y)
+        # a kick inside a thick corrector also offsets the beam by half its length at the exit.
+        kick = parameters['kick']
+        M = M.at[:, 0, 4].set(length / 2 * kick[:, 0]).at[:, 1, 4].set(kick[:, 0])
+        return M.at[:, 2, 4].set(length / 2 * kick[:, 1]).at[:, 3, 4].set(kick[:, 1])
+
+    def Track(self, parameters, particles):
+        '''Tracks `particles` (4 x numParticles of x, px, y, py) and returns their state entering every element and at the exit (numElements + 1 x 4 x numParticles).'''
+        state = jnp.concatenate([particles, jnp.ones((1, particles.shape[1]))])
+        def Step(state, M):
+            return M @ state, state
+        state, states = jax.lax.scan(Step, state, self.Matrices(parameters))
+        return jnp.concatenate([states, state[None]])[:, :4]
+
+    def Orbit(self, parameters, refpts):
+        '''x then y centroid (m) at the entrance of each of the `refpts` for a beam entering on axis.'''
+        centres = self.Track(parameters, jnp.zeros((4, 1)))[np.asarray(refpts), :, 0]
+        return jnp.concatenate([centres[:, 0], centres[:, 2]])
+
+    def OrbitResponse(self, parameters, correctorIdxs, refpts):
+        '''Jacobian (m / rad) of the x then y orbit at the `refpts` with respect to the horizontal and vertical kick of every corrector in `correctorIdxs`,
+        with shape 2 numRefpts x numCorrectors x 2. Both indices are static and must be passed as tuples.'''
+        correctorIdxs = np.asarray(correctorIdxs)
+        def Orbit(kicks):
+            return self.Orbit({**parameters, 'kick': parameters['kick'].at[correctorIdxs].set(kicks)}, refpts)
+        return jax.jacfwd(Orbit)(parameters['kick'][correctorIdxs])
@@ -3,6 +3,7 @@ from at import linopt2
 from at import elements as emnts
 import numpy as np
 from copy import deepcopy
+import hashlib
 import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -304,4 +305,42 @@ def UpdateAperture(apertureBounds, lattice, disable6D = True):
     latticeWithFinalAperture.append(emnts.Drift('Drift', 1e-5)) 
     if disable6D:
         latticeWithFinalAperture.disable_6d()
-    return latticeWithFinalAperture
\ No newline at end of file
+    return latticeWithFinalAperture
+
+def ElementFingerprint(element):
+    '''Returns a hash of an element\'s class and every parameter value, so any change to its settings changes the hash.'''
+    digest = hashlib.blake2b(type(element).__name__.encode(), digest_size = 16)
+    for k, v in sorted(vars(element).items()):
+        digest.update(k.encode())
+        digest.update(np.ascontiguousarray(v).tobytes() if isinstance(v, np.ndarray) else repr(v).encode())
+    return digest.hexdigest()
+
+def LatticeFingerprint(lattice):
+    '''Returns a single hash of the state of every element in the `lattice`.'''
+    digest = hashlib.blake2b(digest_size = 16)
+    for element in lattice:
+        digest.update(ElementFingerprint(element).encode())
+    return digest.hexdigest()
+
+# Dict of apertured lattices -- key is (aperture bounds, energy and fingerprint of the base lattice), value is the apertured lattice.
+aperturedLattices = dict()
+maxAperturedLattices = 8
+
+def ApplyBeamPipeAperture(lattice, bounds):
+    '''Returns a copy of the `lattice` with an aperture of `bounds` in front of every element with length, built in a single pass.\n
+    The result is memoised on the bounds and the state of the base lattice, so repeated calls are free until the lattice changes.
+    The returned lattice is shared between callers and should not be modified.'''
+    key = (tuple(np.ravel(bounds)), lattice.energy, LatticeFingerprint(lattice))
+    if key not in aperturedLattices:
+        aperture = emnts.Aperture('BeamPipe', bounds)
+        aperturedLattice = deepcopy(lattice)
+        elements = []
+        for element in aperturedLattice:
+            if element.Length > 0:
+                elements.append(aperture)
+            elements.append(element)
+        aperturedLattice[:] = elements
+        if len(aperturedLattices) == maxAperturedLattices:
+            aperturedLattices.pop(next(iter(aperturedLattices))) # forget the oldest
+        aperturedLattices[key] = aperturedLattice
+    return aperturedLattices[key]
@@ -0,0 +1,258 @@
+import numpy as np
+import secrets
+import threading
+from copy import deepcopy
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Listener, Client
+from multiprocessing.shared_memory import SharedMemory
+from at import lattice_pass
+from .latticeutils import ElementFingerprint
+from .trackingcache import TrackingCache, BeamFingerprint, ElementsFingerprint
+from ..utils.beams import AttachBeam
+
+'''Long-lived simulation server process that keeps a lattice resident, so actions and previews can track without a copy of the lattice of their own.'''
+
+# Server owned by the main process -- holds the process, its (address, authkey) and the updates queued for it (see StartServer).
+server = dict()
+
+def Serve(lattice, authkey, pipe, maxCacheBytes = 256 * 2 ** 20, cacheDirectory = None):
+    '''Server process target. Listens on a local address (sent back through the `pipe`) and serves each client connection on its own thread.\n
+    Requests are tuples of a command and its args, and each gets a reply of (error message or None, result):\n
+    ('lattice', lattice, sequence) replaces the resident lattice, ('update', {index: {attribute: value}}, sequence) sets attributes of its elements,
+    ('track', beam, refpts, overrides, reduction, output, sequence) tracks a pooled beam through it (see SimulationClient.Track) once the updates up to
+    `sequence` have been applied and ('statistics',) returns the statistics of the tracking cache, which holds up to `maxCacheBytes` of results
+    and spills to `cacheDirectory` if given.'''
+    listener = Listener(authkey = authkey)
+    pipe.send(listener.address)
+    # element fingerprints are kept up to date with the lattice, so a tracking cache key costs nothing to build.
+    state = {'lattice': lattice, 'fingerprints': [ElementFingerprint(e) for e in lattice], 'cache': TrackingCache(maxCacheBytes, cacheDirectory), 'sequence': 0}
+    condition = threading.Condition() # one request at a time touches the lattice, and tracks wait on it for the updates they depend on.
+    while True:
+        connection = listener.accept()
+        threading.Thread(target = ServeConnection, args = (connection, state, condition), daemon = True).start()
+
+def ServeConnection(connection, state, condition, timeout = 30):
+    '''Serves the requests of one client until it disconnects. A track waits at most `timeout` seconds for the updates it depends on.'''
+    beams = dict() # beams attached by this connection -- key is the shared memory name, value is (shared memory, beam, fingerprint)
+    outputs = dict()
+    while True:
+        try:
+            command, *args = connection.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            result = None
+            if command == 'statistics':
+                # counts only, so this does not wait for a track in progress.
+                connection.send((None, state['cache'].Statistics()))
+                continue
+            with condition:
+                if command == 'lattice':
+                    state['lattice'] = args[0]
+                    state['fingerprints'] = [ElementFingerprint(e) for e in state['lattice']]
+                    state['sequence'] = max(state['sequence'], args[1])
+                    condition.notify_all()
+                elif command == 'update':
+                    UpdateElements(state['lattice'], args[0])
+                    for idx in args[0]:
+                        state['fingerprints'][idx] = ElementFingerprint(state['lattice'][idx])
+                    state['sequence'] = max(state['sequence'], args[1])
+                    condition.notify_all()
+                elif command == 'track':
+                    beam, refpts, overrides, reduction, output, sequence = args
+                    if not condition.wait_for(lambda: state['sequence'] >= sequence, timeout):
+                        raise RuntimeError('Timed out waiting for the lattice updates this track depends on.')
+                    if beam[0] not in beams:
+                        sharedMemory, particles = AttachBeam(beam)
+                        beams[beam[0]] = (sharedMemory, particles, BeamFingerprint(particles))
+                    if output[0] not in outputs:
+                        sharedMemory = SharedMemory(name = output[0])
+                        outputs[output[0]] = (sharedMemory, np.ndarray(output[1], output[2], buffer = sharedMemory.buf))
+                    Track(state, beams[beam[0]][1:], refpts, overrides, reduction, outputs[output[0]][1])
+            connection.send((None, result))
+        except Exception as e:
+            connection.send((f'{e}', None))
+    for sharedMemory, *_ in [*beams.values(), *outputs.values()]:
+        sharedMemory.close()
+    connection.close()
+
+def UpdateElements(lattice, deltas):
+    '''Sets the attributes of `deltas` ({index: {attribute: value}}) on the elements of the `lattice`. Returns the replaced values in the same layout.'''
+    previous = {idx: {k: getattr(lattice[idx], k, None) for k in attributes} for idx, attributes in deltas.items()}
+    for idx, attributes in deltas.items():
+        for k, v in attributes.items():
+            setattr(lattice[idx], k, v)
+    return previous
+
+def Track(state, beam, refpts, overrides, reduction, output):
+    '''Tracks a copy of the `beam` (beam, fingerprint) through the lattice of the server `state` with the attribute `overrides` applied for this pass only,
+    and writes the result to `output`. Results are cached on the fingerprints of the elements (with the overrides applied) and the beam.\n
+    `reduction` = <particles/centroid>, for the state (6 x numParticles x numRefpts) or the mean of each coordinate (6 x numRefpts) at the `refpts`.'''
+    lattice, (beam, beamFingerprint) = state['lattice'], beam
+    overrides = overrides or dict()
+    missing = [(idx, k) for idx, attributes in overrides.items() for k in attributes if not hasattr(lattice[idx], k)]
+    previous = UpdateElements(lattice, overrides)
+    try:
+        fingerprints = [ElementFingerprint(lattice[idx]) if idx in overrides else fingerprint for idx, fingerprint in enumerate(state['fingerprints'])]
+        key = (ElementsFingerprint(fingerprints), beamFingerprint, tuple(int(r) for r in refpts), reduction)
+        result = state['cache'].Get(key)
+        if result is None:
+            particles = lattice_pass(lattice, np.array(beam, order = 'F'), nturns = 1, refpts = np.asarray(refpts))[..., 0]
+            result = state['cache'].Put(key, particles if reduction == 'particles' else np.mean(particles, axis = 1))
+    finally:
+        # the resident lattice is left exactly as it was, including attributes the overrides added.
+        UpdateElements(lattice, previous)
+        for idx, k in missing:
+            delattr(lattice[idx], k)
+    output[:] = result
+
+class SimulationClient:
+    '''Connection to the simulation server at `address` ((address, authkey), see SyncServer). It pickles as the address alone, so it can be passed to actions.\n
+    Tracks wait until the server has applied the updates up to `sequence`, so they see the lattice as it was when SyncServer returned it.
+    Results are returned in shared memory the client owns and reuses between calls.'''
+    def __init__(self, address, sequence = 0):
+        self.address = address
+        self.sequence = sequence
+        self.connection = None
+        self.outputs = dict() # shared memory for the results -- key is the result shape
+
+    def __getstate__(self):
+        return {'address': self.address, 'sequence': self.sequence}
+
+    def __setstate__(self, state):
+        self.__init__(state['address'], state['sequence'])
+
+    def Request(self, command, *args):
+        '''Sends a request and returns the result of the reply, raising a RuntimeError if the server could not complete it.'''
+        if self.connection is None:
+            self.connection = Client(self.address[0], authkey = self.address[1])
+        self.connection.send((command, *args))
+        message, result = self.connection.recv()
+        if message is not None:
+            raise RuntimeError(message)
+        return result
+
+    def Update(self, deltas):
+        '''Sets the attributes of `deltas` ({index: {attribute: value}}) on the resident lattice.'''
+        self.Request('update', deltas, self.sequence)
+
+    def Track(self, beam, refpts, overrides = None, reduction = 'particles'):
+        '''Tracks the pooled `beam` description (see utils.beams.PooledBeam) through the resident lattice with the attribute `overrides`
+        ({index: {attribute: value}}) applied for this pass only. `reduction` = <particles/centroid>, see Track.\n
+        Returns a view of the client\'s shared memory, which the next call of the same shape overwrites.'''
+        shape = (6, beam[1][1], len(refpts)) if reduction == 'particles' else (6, len(refpts))
+        if shape not in self.outputs:
+            sharedMemory = SharedMemory(create = True, size = int(np.prod(shape)) * np.dtype(np.float64).itemsize)
+            self.outputs[shape] = (sharedMemory, np.ndarray(shape, np.float64, buffer = sharedMemory.buf))
+        sharedMemory, output = self.outputs[shape]
+        self.Request('track', beam, list(refpts), overrides, reduction, (sharedMemory.name, shape, np.dtype(np.float64)), self.sequence)
+        return output
+
+    def Statistics(self):
+        '''Returns the statistics of the server\'s tracking cache (see TrackingCache.Statistics).'''
+        return self.Request('statistics')
+
+    def Close(self):
+        '''Disconnects and removes the result shared memory.'''
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        for sharedMemory, _ in self.outputs.values():
+            sharedMemory.close()
+            sharedMemory.unlink()
+        self.outputs.clear()
+
+def StartServer(lattice):
+    '''Starts the server with a copy of the `lattice`, once at app start. Call from the main process.\n
+    Never blocks: the process is started by a background thread, which then waits for its address and sends the updates queued by
+    UpdateServer and SyncServer (see SendUpdates), so neither the start nor an update waits on the server.'''
+    if 'process' in server:
+        return
+    server.update(
+        authkey = secrets.token_bytes(16),
+        address = None, # set by the background thread once the server is listening.
+        fingerprints = [ElementFingerprint(element) for element in lattice], # fingerprints of the elements as queued for the server.
+        pending = dict(), # attributes waiting to be sent -- key is the element index, so updates of the same element are coalesced.
+        replacement = None, # a lattice of a different length, which is sent whole.
+        sequence = 0, # counts the queued updates, so a track request can wait until the server has applied all of those before it.
+        lock = threading.Lock(),
+        wake = threading.Event(),
+    )
+    parentPipe, childPipe = Pipe()
+    server['process'] = Process(target = Serve, args = (deepcopy(lattice), server['authkey'], childPipe), daemon = True)
+    threading.Thread(target = SendUpdates, args = (parentPipe,), daemon = True).start()
+
+def SendUpdates(pipe):
+    '''Background thread of the main process. Starts the server process and waits for its address on the `pipe`,
+    then sends the queued updates, coalesced, whenever there are any.'''
+    server['process'].start()
+    address = (pipe.recv(), server['authkey'])
+    client = SimulationClient(address)
+    with server['lock']:
+        server['address'] = address
+    while True:
+        server['wake'].wait()
+        with server['lock']:
+            server['wake'].clear()
+            pending, replacement, sequence = server['pending'], server['replacement'], server['sequence']
+            server['pending'], server['replacement'] = dict(), None
+        try:
+            if replacement is not None:
+                client.Request('lattice', replacement, sequence)
+            if pending or replacement is None:
+                client.Request('update', pending, sequence)
+        except (EOFError, OSError, RuntimeError):
+            return # the server has stopped.
+
+def UpdateServer(lattice, indices):
+    '''Queues the elements at `indices` of the `lattice` for the server, e.g. after a slider moves. Call from the main process.\n
+    Returns straight away; a later update of the same element replaces this one if it has not been sent yet.'''
+    if 'process' not in server:
+        return
+    with server['lock']:
+        for idx in indices:
+            server['pending'].setdefault(idx, dict()).update(vars(lattice[idx]))
+            server['fingerprints'][idx] = ElementFingerprint(lattice[idx])
+        server['sequence'] += 1
+    server['wake'].set()
+
+def SyncServer(lattice):
+    '''Queues the elements of the `lattice` that changed since they were last queued (or the whole lattice if its length changed). Call from the main process.\n
+    Never blocks. Returns the (address, sequence) to construct a SimulationClient from, whose requests wait for these updates,
+    or None if the server has not been started or is not listening yet.'''
+    if 'process' not in server:
+        return None
+    fingerprints = [ElementFingerprint(element) for element in lattice]
+    with server['lock']:
+        if len(fingerprints) != len(server['fingerprints']):
+            server['replacement'], server['pending'] = deepcopy(lattice), dict()
+            server['sequence'] += 1
+        else:
+            changed = [idx for idx, fingerprint in enumerate(fingerprints) if fingerprint != server['fingerprints'][idx]]
+            for idx in changed:
+                server['pending'].setdefault(idx, dict()).update(vars(lattice[idx]))
+            server['sequence'] += 1 if changed else 0
+        server['fingerprints'] = fingerprints
+        if server['address'] is None:
+            return None
+        description = (server['address'], server['sequence'])
+    server['wake'].set()
+    return description
+
+def CacheStatistics():
+    '''Returns the statistics of the server\'s tracking cache, or None if it is not running. Call from the main process.\n
+    Statistics are served without waiting for a track in progress, so this is safe to call from the GUI thread.'''
+    if server.get('address') is None or not server['process'].is_alive():
+        return None
+    if 'statisticsClient' not in server:
+        server['statisticsClient'] = SimulationClient(server['address'])
+    return server['statisticsClient'].Statistics()
+
+def StopServer():
+    '''Stops the server and removes the main process client.'''
+    if 'statisticsClient' in server:
+        server['statisticsClient'].Close()
+    if 'process' in server and server['process'].is_alive():
+        server['process'].terminate()
+        server['process'].join()
+    server.clear()
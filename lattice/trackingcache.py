@@ -0,0 +1,86 @@
+import numpy as np
+import hashlib
+import os
+
+'''Memory-bounded LRU cache of tracking results, keyed on the content of the lattice and the beam.'''
+
+def BeamFingerprint(beam):
+    '''Returns a hash of the particle coordinates of a `beam` (6 x numParticles), which stands in for its twiss, number of particles and seed.'''
+    return hashlib.blake2b(np.ascontiguousarray(beam).tobytes(), digest_size = 16).hexdigest()
+
+def ElementsFingerprint(fingerprints):
+    '''Returns a single hash of a list of element `fingerprints` (see latticeutils.ElementFingerprint), equal to LatticeFingerprint of the same elements.'''
+    digest = hashlib.blake2b(digest_size = 16)
+    for fingerprint in fingerprints:
+        digest.update(fingerprint.encode())
+    return digest.hexdigest()
+
+class TrackingCache:
+    '''Least recently used cache of tracking results (numpy arrays) that holds at most `maxBytes` in memory.\n
+    Keys should include a fingerprint of every element parameter and of the beam, so a hit is always the result of an identical pass.
+    If a `directory` is given, evicted results are spilled there as .npy files and read back on a later miss.\n
+    Hits, disk hits and misses are counted so the size can be tuned (see Statistics).'''
+    def __init__(self, maxBytes = 256 * 2 ** 20, directory = None):
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.entries = dict() # most recently used entries are kept at the end.
+        self.numBytes = 0
+        self.hits, self.diskHits, self.misses = 0, 0, 0
+
+    def Path(self, key):
+        return os.path.join(self.directory, f'{hashlib.blake2b(repr(key).encode(), digest_size = 16).hexdigest()}.npy')
+
+    def Get(self, key):
+        '''Returns the cached result for `key` (read-only), or None on a miss.'''
+        if key in self.entries:
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.directory is not None and os.path.exists(self.Path(key)):
+            self.diskHits += 1
+            return self.Put(key, np.load(self.Path(key)))
+        self.misses += 1
+        return None
+
+    def Put(self, key, value):
+        '''Stores `value` under `key`, evicting (and spilling) the least recently used results to stay within `maxBytes`, and returns it.\n
+        The value is stored without a copy, so the cache takes ownership and marks it read-only; callers should pass a result they no longer write to.
+        A value larger than `maxBytes` is not stored, and is returned as it is.'''
+        value = np.asarray(value)
+        if value.nbytes > self.maxBytes:
+            return value
+        value.flags.writeable = False
+        if key in self.entries:
+            self.numBytes -= self.entries.pop(key).nbytes
+        self.entries[key] = value
+        self.numBytes += value.nbytes
+        while self.numBytes > self.maxBytes and self.entries:
+            evictedKey = next(iter(self.entries))
+            evicted = self.entries.pop(evictedKey)
+            self.numBytes -= evicted.nbytes
+            if self.directory is not None:
+                os.makedirs(self.directory, exist_ok = True)
+                np.save(self.Path(evictedKey), evicted)
+        return self.entries.get(key, value)
+
+    def Clear(self):
+        '''Empties the cache and removes its spilled results, and resets the counts.'''
+        self.entries.clear()
+        self.numBytes = 0
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(self.directory, name))
+        self.hits, self.diskHits, self.misses = 0, 0, 0
+
+    def Statistics(self):
+        '''Returns a dict of the `hits`, `diskHits` and `misses` so far, the `hitRate` (memory and disk) and the `entries` and `bytes` held in memory.'''
+        lookups = self.hits + self.diskHits + self.misses
+        return {
+            'hits': self.hits,
+            'diskHits': self.diskHits,
+            'misses': self.misses,
+            'hitRate': (self.hits + self.diskHits) / lookups if lookups else 0.,
+            'entries': len(self.entries),
+            'bytes': self.numBytes,
+        }
@@ -1,13 +1,18 @@
-import at
 import numpy as np
-from copy import deepcopy
+from multiprocessing.shared_memory import SharedMemory
 from . import shared
+from .utils.beams import SampleBeam, AttachBeam
+from .utils.multiprocessing import AttachSharedArray, CloseSharedMemories, RunWorkers
+from .lattice.latticeutils import ElementFingerprint, ApplyBeamPipeAperture
+from .lattice.trackingcache import TrackingCache, ElementsFingerprint, BeamFingerprint
 
 class Simulator:
     '''Handles offline simulations with the lattice.'''
-    def __init__(self, numParticles = 10000, inputTwiss = None, window = None):
+    def __init__(self, numParticles = 10000, inputTwiss = None, window = None, seed = 0, numWorkers = 1, maxCacheBytes = 256 * 2 ** 20, cacheDirectory = None):
         self.parent = window
         self.numParticles = numParticles
+        self.seed = seed
+        self.numWorkers = numWorkers # processes the particles are split between in chunked mode.
         if inputTwiss is None:
             self.inputTwiss = {
                 'betax': 3.731,
@@ -21,17 +26,171 @@ class Simulator:
             }
         else:
             self.inputTwiss = inputTwiss
+        # the beam state entering every element of the last tracked lattice, reused as checkpoints by the next call.
+        self.checkpoints = np.empty((6, 0, 0, 1))
+        self.fingerprints = [] # fingerprint of each element the checkpoints were tracked through.
+        self.beamKey = None # number of particles, input twiss and seed the initial beam was sampled with, or the fingerprint of a given beam.
+        # moments mode only keeps the beam state at segment boundaries, plus the moments at every element.
+        self.segmentStates = dict() # first element index of a segment -> particles entering it
+        self.segmentFingerprints = [] # fingerprint of each element the segment states and moments were tracked through.
+        self.moments = None
+        # full tracking results of earlier lattice states, keyed on the lattice and beam (see CacheStatistics for its hit rate).
+        self.cache = TrackingCache(maxCacheBytes, cacheDirectory)
 
-    def Run(self):
+    def Run(self, mode = 'particles'):
+        '''`mode` = <particles/moments/chunked>'''
+        if mode == 'moments':
+            return self.TrackMoments()['transmission'][-1]
+        if mode == 'chunked':
+            return self.TrackChunked()['survived'].mean()
         pOut, _ = self.TrackBeam()
         return self.CalculateSurvivingFraction(pOut)
 
-    def TrackBeam(self):
-        sigmaMat = at.sigma_matrix(**self.inputTwiss)
-        beam = at.beam(self.numParticles, sigmaMat)
-        pOut, *_ = shared.lattice.track(beam, refpts = np.arange(len(shared.lattice)), nturns = 1);
+    def InitialBeam(self, beam = None):
+        '''Returns the particles entering the lattice, which are only sampled again when the number of particles, the input twiss or the seed changes.\n
+        A given `beam` (6 x numParticles) is used instead, e.g. a pooled beam shared with other processes, and sets the number of particles.'''
+        if beam is not None:
+            key = ('beam', BeamFingerprint(beam))
+            if key != self.beamKey:
+                self.beam = beam
+                self.numParticles = beam.shape[1]
+                self.beamKey = key
+                self.InvalidateCheckpoints()
+            return self.beam
+        key = (self.numParticles, tuple(sorted(self.inputTwiss.items())), self.seed)
+        if key != self.beamKey:
+            self.beam = SampleBeam(self.numParticles, self.inputTwiss, self.seed)
+            self.beamKey = key
+            self.InvalidateCheckpoints()
+        return self.beam
+
+    def InvalidateCheckpoints(self, elementIdx = 0):
+        '''Forgets the beam state downstream of `elementIdx`, so the next call to TrackBeam tracks from there.'''
+        self.fingerprints = self.fingerprints[:elementIdx]
+        self.segmentFingerprints = self.segmentFingerprints[:elementIdx]
+
+    def TrackBeam(self, lattice = None):
+        '''Tracks the beam through the `lattice` (defaults to the shared lattice), returning its state entering every element.\n
+        Elements are fingerprinted and compared with the last call. The state entering the first changed element only depends on the elements
+        upstream of it, so tracking resumes from that checkpoint instead of element 0.
+        Any lattice state tracked before with the same beam is returned straight from the cache. Results the cache holds are read-only,
+        which includes new results unless they are larger than the cache, so copy the result before writing to it.\n
+        This is a library entry point for scripted studies and no block calls it, as the in-app paths resume on their own:
+        the ORM tracks each column from the beam at its corrector and the error ensemble uses TrackMoments.'''
+        lattice = shared.lattice if lattice is None else lattice
+        beam = self.InitialBeam()
+        fingerprints = [ElementFingerprint(element) for element in lattice]
+        key = (ElementsFingerprint(fingerprints), self.beamKey)
+        cached = self.cache.Get(key)
+        if cached is not None:
+            self.checkpoints, self.fingerprints = cached, fingerprints
+            return cached, []
+        # the entrance of the last cached element is the furthest state known, as exits are not stored.
+        start = min(len(self.fingerprints) - 1, len(fingerprints) - 1)
+        start = next((idx for idx in range(max(start, 0)) if fingerprints[idx] != self.fingerprints[idx]), max(start, 0))
+        if start == 0:
+            pOut, *_ = lattice.track(beam.copy(order = 'F'), refpts = np.arange(len(lattice)), nturns = 1);
+        else:
+            # copied, as the checkpoints may be a read-only cached result and tracking is in place.
+            resumed, *_ = lattice[start:].track(np.array(self.checkpoints[:, :, start, 0], order = 'F'), refpts = np.arange(len(lattice) - start), nturns = 1);
+            pOut = np.concatenate([self.checkpoints[:, :, :start], resumed], axis = 2)
+        pOut = self.cache.Put(key, pOut)
+        self.checkpoints = pOut
+        self.fingerprints = fingerprints
         return pOut, _
 
+    def TrackMoments(self, lattice = None, segmentLength = 50, beam = None):
+        '''Tracks the beam (or a given `beam`, see InitialBeam) through the `lattice` (defaults to the shared lattice) `segmentLength` elements at a time,
+        reducing each segment to the beam moments entering its elements before tracking the next.\n
+        Memory scales with the segment rather than the whole lattice. Tracking resumes from the last segment boundary upstream of the first changed element.\n
+        Returns a dict of the `transmission` (numElements), `centroid` (numElements x 6) and `sigma` matrix (numElements x 6 x 6) of the surviving particles.'''
+        lattice = shared.lattice if lattice is None else lattice
+        beam = self.InitialBeam(beam)
+        fingerprints = [ElementFingerprint(element) for element in lattice]
+        numElements = len(lattice)
+        if self.moments is None or len(self.moments['transmission']) != numElements or self.moments['segmentLength'] != segmentLength:
+            self.segmentFingerprints = []
+            self.moments = {
+                'transmission': np.full(numElements, np.nan),
+                'centroid': np.full((numElements, 6), np.nan),
+                'sigma': np.full((numElements, 6, 6), np.nan),
+                'segmentLength': segmentLength,
+            }
+        changed = next((idx for idx, fingerprint in enumerate(self.segmentFingerprints) if fingerprint != fingerprints[idx]), len(self.segmentFingerprints))
+        if changed == numElements:
+            return {k: v.copy() for k, v in self.moments.items() if k != 'segmentLength'} # nothing changed since the last call.
+        # clamped to the start of the last segment, whose state is the furthest one stored.
+        start = min(changed, numElements - 1) // segmentLength * segmentLength
+        state = beam.copy(order = 'F') if start == 0 else self.segmentStates[start].copy(order = 'F')
+        for first in range(start, numElements, segmentLength):
+            last = min(first + segmentLength, numElements)
+            self.segmentStates[first] = state
+            # the extra reference point is the exit of the segment, which enters the next one.
+            segmentOut, *_ = lattice[first:last].track(state.copy(order = 'F'), refpts = np.arange(last - first + 1), nturns = 1);
+            transmission, centroid, sigma = self.CalculateMoments(segmentOut[:, :, :-1, 0])
+            self.moments['transmission'][first:last] = transmission
+            self.moments['centroid'][first:last] = centroid
+            self.moments['sigma'][first:last] = sigma
+            state = np.asfortranarray(segmentOut[:, :, -1, 0])
+        self.segmentFingerprints = fingerprints
+        return {k: v.copy() for k, v in self.moments.items() if k != 'segmentLength'}
+
+    def TrackChunked(self, lattice = None, numWorkers = None, segmentLength = 50):
+        '''Splits the beam into one chunk of particles per worker (defaults to `numWorkers` of the simulator) and tracks the chunks concurrently
+        through the `lattice` (defaults to the shared lattice), `segmentLength` elements at a time.\n
+        Each worker only returns the sums of the coordinates and of their products at every element, which add up across chunks,
+        so the moments of the whole beam are exact while no worker holds more than a segment of its chunk.\n
+        Returns a dict of the `transmission`, `centroid` and `sigma` entering every element (as TrackMoments), the element each particle was lost in
+        (`lossElement`, numElements for survivors) and the `survived` mask at the exit.\n
+        This is a library entry point for loss studies with many particles. The in-app engines already spread their work over processes
+        by corrector column (ORM) or error seed (ensemble), so none of them calls it.'''
+        lattice = shared.lattice if lattice is None else lattice
+        beam = self.InitialBeam()
+        numElements = len(lattice)
+        numWorkers = min(self.numWorkers if numWorkers is None else numWorkers, self.numParticles)
+        chunks = np.array_split(np.arange(self.numParticles), numWorkers)
+        if numWorkers == 1:
+            lossElement = np.full(self.numParticles, numElements, dtype = np.int64)
+            results = [ChunkMomentSums(lattice, beam.copy(order = 'F'), segmentLength, lossElement)]
+        else:
+            # the beam and the loss elements live in shared memory, so each worker only reads and writes its own columns.
+            beamSharedMemory = SharedMemory(create = True, size = beam.nbytes)
+            np.ndarray(beam.shape, beam.dtype, buffer = beamSharedMemory.buf, order = 'F')[:] = beam
+            lossSharedMemory = SharedMemory(create = True, size = self.numParticles * np.dtype(np.int64).itemsize)
+            lossElement = np.ndarray(self.numParticles, np.int64, buffer = lossSharedMemory.buf)
+            lossElement[:] = numElements
+            try:
+                results = RunWorkers(TrackChunk, [
+                    (lattice, (beamSharedMemory.name, beam.shape, beam.dtype), chunk[0], chunk[-1] + 1, segmentLength, (lossSharedMemory.name, lossElement.shape, lossElement.dtype))
+                    for chunk in chunks
+                ])
+                lossElement = lossElement.copy()
+            finally:
+                for sharedMemory in [beamSharedMemory, lossSharedMemory]:
+                    sharedMemory.close()
+                    sharedMemory.unlink()
+        message = next((r for r in results if isinstance(r, str)), None)
+        if message is not None:
+            raise RuntimeError(message)
+        count, sums, products = (sum(r[i] for r in results) for i in range(3))
+        transmission, centroid, sigma = self.MomentsFromSums(count, sums, products)
+        return {'transmission': transmission, 'centroid': centroid, 'sigma': sigma, 'lossElement': lossElement, 'survived': lossElement == numElements}
+
+    def CacheStatistics(self):
+        '''Hits, misses and hit rate of the tracking cache (see TrackingCache.Statistics), to tune `maxCacheBytes`.'''
+        return self.cache.Statistics()
+
+    def CalculateMoments(self, particles):
+        '''Reduces `particles` (6 x numParticles x numPositions) to the surviving fraction, centroid and sigma matrix at each position.'''
+        return self.MomentsFromSums(*MomentSums(particles))
+
+    def MomentsFromSums(self, count, sums, products):
+        '''Surviving fraction, centroid and sigma matrix at each position from the particle `count` and the `sums` and `products` of MomentSums.'''
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            centroid = sums / count[:, None]
+            sigma = products / count[:, None, None] - centroid[:, :, None] * centroid[:, None, :]
+        return count / self.numParticles, centroid, sigma
+
     def CalculateSurvivingFraction(self, pOut, returnMask = False):
         finalState = pOut[:, :, -1].T
         survived = np.sum(~np.any(np.isnan(finalState), axis = -1))
@@ -51,10 +210,41 @@ class Simulator:
                 shared.lattice[slider['elementIdx']].KickAngle = kickAngle
 
     def ApplyGlobalBeamPipeAperture(self, bounds):
-        newLattice = deepcopy(shared.lattice)
-        aperture = at.elements.Aperture('BeamPipe', bounds)
+        '''Returns the shared lattice with a beam pipe aperture of `bounds` in front of every element with length (memoised, do not modify it).'''
+        return ApplyBeamPipeAperture(shared.lattice, bounds)
+
+def MomentSums(particles):
+    '''Reduces `particles` (6 x numParticles x numPositions) to the number of surviving particles, the sums of their coordinates (numPositions x 6)
+    and the sums of the products of their coordinates (numPositions x 6 x 6) at each position.\n
+    Lost particles (NaN) are zeroed and left out of the counts. Sums of separate sets of particles add up to the sums of their union.'''
+    survived = ~np.isnan(particles).any(axis = 0) # numParticles x numPositions
+    coordinates = np.where(survived, particles, 0)
+    return survived.sum(axis = 0), np.einsum('ipn->ni', coordinates), np.einsum('ipn,jpn->nij', coordinates, coordinates)
+
+def ChunkMomentSums(lattice, particles, segmentLength, lossElement):
+    '''Tracks `particles` (6 x numParticles, Fortran order) through the `lattice` a segment at a time and returns the MomentSums entering every element.\n
+    The index of the element each particle is lost in is written to `lossElement`, which holds the number of elements for particles not yet lost.'''
+    numElements = len(lattice)
+    count, sums, products = np.zeros(numElements, dtype = np.int64), np.zeros((numElements, 6)), np.zeros((numElements, 6, 6))
+    state = particles
+    for first in range(0, numElements, segmentLength):
+        last = min(first + segmentLength, numElements)
+        segmentOut, *_ = lattice[first:last].track(state, refpts = np.arange(last - first + 1), nturns = 1);
+        count[first:last], sums[first:last], products[first:last] = MomentSums(segmentOut[:, :, :-1, 0])
+        # particles entering the segment alive but lost at the exit of an element in it.
+        alive = ~np.isnan(segmentOut[:, :, 1:, 0]).any(axis = 0) # numParticles x (last - first)
+        lost = (lossElement == numElements) & ~alive[:, -1]
+        lossElement[lost] = first + np.argmin(alive[lost], axis = 1)
+        state = np.asfortranarray(segmentOut[:, :, -1, 0])
+    return count, sums, products
 
-        for _ in range(len(newLattice) - 1, -1, -1):
-            if newLattice[_].Length > 0:
-                newLattice.insert(_, aperture)
-        return newLattice
\ No newline at end of file
+def TrackChunk(lattice, beam, first, last, segmentLength, lossElement, queue):
+    '''Worker process target. Tracks columns `first` to `last` of the pooled `beam` description and puts their MomentSums on the `queue`,
+    writing where each particle was lost to the shared `lossElement` array (description).'''
+    beamSharedMemory, beam = AttachBeam(beam)
+    lossSharedMemory, lossElement = AttachSharedArray(*lossElement)
+    try:
+        queue.put(ChunkMomentSums(lattice, np.array(beam[:, first:last], order = 'F'), segmentLength, lossElement[first:last]))
+    except Exception as e:
+        queue.put(f'{e}')
+    CloseSharedMemories([beamSharedMemory, lossSharedMemory])
@@ -0,0 +1,47 @@
+import at
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+'''Seeded beam distributions, pooled in shared memory so blocks, actions and worker processes all track the same particles.'''
+
+# twiss in values for the LTB
+LTBTwiss = dict(betax = 3.731, betay = 2.128, alphax = -.0547, alphay = -.1263, emitx = 2.6e-7, emity = 2.6e-7, blength = 0, espread = 1.5e-2)
+# twiss in values for the BTS
+BTSTwiss = dict(betax = 12.13, betay = 2.94, alphax = -2.92, alphay = .75, emitx = 2.6e-7, emity = 2.6e-7, blength = 0, espread = 1.5e-2)
+
+# Dict of pooled beams -- key is (twiss, numParticles, seed), value is the shared memory holding the 6 x numParticles beam in Fortran order.
+beamPool = dict()
+
+def SampleBeam(numParticles, twiss = BTSTwiss, seed = 0):
+    '''Returns a Gaussian beam (6 x `numParticles`, Fortran order as PyAT tracks it in place) with the sigma matrix of `twiss`.\n
+    The same `seed` always gives the same particles. The square root of the sigma matrix comes from its eigendecomposition,
+    so planes without spread (e.g. `blength` = 0) are allowed.'''
+    eigenvalues, eigenvectors = np.linalg.eigh(at.sigma_matrix(**twiss))
+    root = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+    return np.asfortranarray(root @ np.random.default_rng(seed).standard_normal((6, numParticles)))
+
+def PooledBeam(numParticles, twiss = BTSTwiss, seed = 0):
+    '''Returns the (shared memory name, shape, dtype) of the pooled beam for `twiss`, `numParticles` and `seed`, sampling it into shared memory on first request.\n
+    Call from the main process, which owns the pool, and pass the result to an action to attach with AttachBeam.'''
+    key = (tuple(sorted(twiss.items())), numParticles, seed)
+    if key not in beamPool:
+        beam = SampleBeam(numParticles, twiss, seed)
+        beamPool[key] = SharedMemory(create = True, size = beam.nbytes)
+        np.ndarray(beam.shape, beam.dtype, buffer = beamPool[key].buf, order = 'F')[:] = beam
+    return (beamPool[key].name, (6, numParticles), np.dtype(np.float64))
+
+def AttachBeam(beam):
+    '''Attach read-only to a pooled `beam` description from PooledBeam. Returns the shared memory and the beam.\n
+    Tracking modifies particles in place, so copy the beam into a scratch array with np.copyto before each pass.'''
+    sharedMemoryName, shape, dtype = beam
+    sharedMemory = SharedMemory(name = sharedMemoryName)
+    beam = np.ndarray(shape, dtype, buffer = sharedMemory.buf, order = 'F')
+    beam.flags.writeable = False
+    return sharedMemory, beam
+
+def ReleaseBeams():
+    '''Remove every pooled beam from memory.'''
+    for sharedMemory in beamPool.values():
+        sharedMemory.close()
+        sharedMemory.unlink()
+    beamPool.clear()
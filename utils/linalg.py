@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.linalg import svd
+
+'''Linear algebra routines shared between actions and blocks.'''
+
+def FitPolynomial(y: np.ndarray, x: np.ndarray, order: int = 1):
+    '''Least squares fit of a polynomial of `order` to the last axis of `y`, where every fit shares the sample points `x`.\n
+    The design matrix is built and inverted once, so all fits are solved in one batched matrix product.\n
+    Returns the coefficients (increasing powers of `x`) and their standard errors, each with shape `y.shape[:-1] + (order + 1,)`.\n
+    Errors are NaN when there are not more samples than coefficients.'''
+    designMatrix = np.vander(x, order + 1, increasing = True) # numSamples x (order + 1)
+    coefficients = y @ np.linalg.pinv(designMatrix).T
+    residuals = y - coefficients @ designMatrix.T
+    degreesOfFreedom = len(x) - (order + 1)
+    if degreesOfFreedom > 0:
+        variance = np.sum(residuals ** 2, axis = -1) / degreesOfFreedom # same scaling as np.polyfit(..., cov = True)
+    else:
+        variance = np.full(y.shape[:-1], np.nan)
+    errors = np.sqrt(variance[..., None] * np.diag(np.linalg.inv(designMatrix.T @ designMatrix)))
+    return coefficients, errors
+
+def CausalMask(BPMIdxs, correctorIdxs):
+    '''In a transfer line a corrector only moves the beam at BPMs downstream of it, so every other (BPM, corrector) pair of the ORM is structurally zero.\n
+    Returns a boolean mask of shape (numBPMs, numCorrectors) from the lattice indices of each, which order them by s-position.'''
+    return np.asarray(BPMIdxs)[:, None] > np.asarray(correctorIdxs)[None, :]
+
+def CausalSVD(matrix: np.ndarray, causalMask: np.ndarray, rank: int = None):
+    '''Economy SVD of a `matrix` whose entries outside `causalMask` are structurally zero.\n
+    Rows with no causal entries (BPMs upstream of every corrector) and columns with none (correctors downstream of every BPM)
+    are stripped before decomposing, and the singular vectors are embedded back, so the nonzero singular triplets match those of the full matrix.
+    Only these empty rows and columns are exploited: the ORM stays dense, as the views, saving and rank one column updates all index it directly.\n
+    If a `rank` is given, only that many leading triplets are computed with a randomised SVD.'''
+    rows, columns = causalMask.any(axis = 1), causalMask.any(axis = 0)
+    reduced = np.where(causalMask, matrix, 0)[np.ix_(rows, columns)]
+    u, s, vt = svd(reduced, full_matrices = False) if rank is None else RandomisedSVD(reduced, rank)
+    U = np.zeros((matrix.shape[0], len(s)))
+    U[rows] = u
+    VT = np.zeros((len(s), matrix.shape[1]))
+    VT[:, columns] = vt
+    return U, s, VT
+
+def RandomisedSVD(matrix: np.ndarray, rank: int, oversampling: int = 10, powerIterations: int = 2, seed = None):
+    '''Leading `rank` singular triplets of `matrix` by randomised range finding (Halko, Martinsson and Tropp).\n
+    The range is sketched with `rank + oversampling` random vectors and sharpened by `powerIterations`, so only a small dense SVD is needed.'''
+    rank = min(rank, *matrix.shape)
+    sketch = matrix @ np.random.default_rng(seed).standard_normal((matrix.shape[1], min(rank + oversampling, matrix.shape[1])))
+    Q, _ = np.linalg.qr(sketch)
+    for _ in range(powerIterations):
+        Q, _ = np.linalg.qr(matrix.T @ Q)
+        Q, _ = np.linalg.qr(matrix @ Q)
+    u, s, vt = svd(Q.T @ matrix, full_matrices = False)
+    return (Q @ u)[:, :rank], s[:rank], vt[:rank]
+
+def PseudoInverseLadder(U: np.ndarray, s: np.ndarray, VT: np.ndarray, tolerance: float = 1e-10):
+    '''Pseudo-inverse of U diag(`s`) VT truncated to every number of modes, with shape numModes x VT.shape[1] x U.shape[0].\n
+    Entry k - 1 keeps the k largest singular values. Each level adds one rank one term to the level before, so all are built with a single cumulative sum.
+    Modes with singular values below `tolerance` relative to the largest are dropped, so there are only as many levels as modes kept.'''
+    k = np.count_nonzero(s > tolerance * s[0]) if len(s) else 0
+    return np.cumsum(np.einsum('ki,jk->kij', VT[:k] / s[:k, None], U[:, :k]), axis = 0)
+
+def TruncatedPseudoInverse(U: np.ndarray, s: np.ndarray, VT: np.ndarray, truncation: int = None, tolerance: float = 1e-10):
+    '''Pseudo-inverse of U diag(`s`) VT keeping at most the `truncation` largest singular values, with shape VT.shape[1] x U.shape[0].\n
+    Modes with singular values below `tolerance` relative to the largest are dropped, as inverting them would only amplify noise.'''
+    k = len(s) if truncation is None else min(truncation, len(s))
+    if k > 0:
+        k = min(k, np.count_nonzero(s[:k] > tolerance * s[0]))
+    return (VT[:k].T / s[:k]) @ U[:, :k].T
+
+def TikhonovSolve(A: np.ndarray, B: np.ndarray, regularisation: float = 0):
+    '''Solves min ||A X - B||^2 + `regularisation` ||X||^2 for every column of `B` in one factorisation.\n
+    With no regularisation this is the minimum norm least squares solution. Returns X with shape (A.shape[1],) + B.shape[1:].'''
+    if regularisation == 0:
+        return np.linalg.lstsq(A, B, rcond = None)[0]
+    return np.linalg.solve(A.T @ A + regularisation * np.eye(A.shape[1]), A.T @ B)
+
+def SolveCorrections(U: np.ndarray, s: np.ndarray, VT: np.ndarray, orbits: np.ndarray, regularisation = 0, truncation: int = None, tolerance: float = 1e-10):
+    '''Corrector changes that cancel every orbit in `orbits` (numOrbits x numBPMs), using the cached SVD U diag(`s`) VT of the ORM.\n
+    `regularisation` is the Tikhonov strength, which damps each mode by s / (s^2 + regularisation). Pass a 1D array to sweep every strength in one vectorised pass.
+    `truncation` keeps only that many leading modes, and modes below `tolerance` relative to the largest are dropped as in `TruncatedPseudoInverse`.\n
+    Returns numOrbits x numCorrectors, or numStrengths x numOrbits x numCorrectors if `regularisation` is an array.'''
+    k = len(s) if truncation is None else min(truncation, len(s))
+    if k > 0:
+        k = min(k, np.count_nonzero(s[:k] > tolerance * s[0])) # otherwise a zero strength divides by vanishing modes.
+    strengths = np.atleast_1d(regularisation)
+    filters = s[:k] / (s[:k] ** 2 + strengths[:, None]) # numStrengths x k
+    projections = orbits @ U[:, :k] # a single matrix product projects every orbit onto the modes.
+    corrections = -(projections[None] * filters[:, None, :]) @ VT[:k]
+    return corrections if np.ndim(regularisation) else corrections[0]
+
+def RankOneUpdate(U: np.ndarray, s: np.ndarray, VT: np.ndarray, a: np.ndarray, b: np.ndarray, tolerance: float = 1e-12):
+    '''Thin SVD of U diag(`s`) VT + `a` `b`^T, updated from the existing decomposition (Brand, 2006).\n
+    Only a (k + 1) x (k + 1) SVD is computed for k singular values, instead of decomposing the whole matrix again.
+    Singular values below `tolerance` relative to the largest are dropped.'''
+    m = U.T @ a # components of a and b inside the current column and row spaces
+    p = a - U @ m
+    n = VT @ b
+    q = b - VT.T @ n
+    pNorm, qNorm = np.linalg.norm(p), np.linalg.norm(q)
+    pNorm = pNorm if pNorm > tolerance * np.linalg.norm(a) else 0 # a and b already lie in the spans
+    qNorm = qNorm if qNorm > tolerance * np.linalg.norm(b) else 0
+    P = p / pNorm if pNorm else np.zeros_like(p)
+    Q = q / qNorm if qNorm else np.zeros_like(q)
+    K = np.diag(np.append(s, 0)) + np.outer(np.append(m, pNorm), np.append(n, qNorm))
+    u, s, vt = svd(K)
+    rank = np.count_nonzero(s > tolerance * s[0])
+    return np.column_stack([U, P]) @ u[:, :rank], s[:rank], vt[:rank] @ np.vstack([VT, Q])
+
+def AppendColumn(U: np.ndarray, s: np.ndarray, VT: np.ndarray, column: np.ndarray):
+    '''Thin SVD of the matrix with `column` appended, updated from its existing SVD.'''
+    VT = np.hstack([VT, np.zeros((len(s), 1))])
+    b = np.zeros(VT.shape[1])
+    b[-1] = 1
+    return RankOneUpdate(U, s, VT, column, b)
+
+def ReplaceColumn(U: np.ndarray, s: np.ndarray, VT: np.ndarray, index: int, column: np.ndarray):
+    '''Thin SVD of the matrix with the column at `index` replaced by `column`, updated from its existing SVD.'''
+    b = np.zeros(VT.shape[1])
+    b[index] = 1
+    return RankOneUpdate(U, s, VT, column - (U * s) @ VT[:, index], b)
@@ -65,6 +65,14 @@ def Load(path):
                         entity.settings['size'] = v['size']
                         if 'alignment' in v:
                             entity.settings['alignment'] = v['alignment']
+                        if 'engine' in v and v['engine'] in entity.offlineEngines: # blocks are always loaded offline.
+                            entity.SetEngine(v['engine'])
+                        if 'order' in v:
+                            entity.SetOrderLinear() if v['order'] == 'Linear' else entity.SetOrderQuadratic()
+                        if 'coupled' in v:
+                            entity.SetCoupled(v['coupled'])
+                        if 'method' in v:
+                            entity.SetMethod(v['method'])
                         entity.setFixedSize(*v['size'])
                         if 'linkedElement' in v:
                             if shared.elements is None: # fetch lattice info if this is the first time instantiating a linked block.
@@ -77,7 +85,7 @@ def Load(path):
                                 v['components'][componentName]['type'] = componentsLookup[c['type']]
                                 if 'valueType' in v['components'][componentName]:
                                     v['components'][componentName]['valueType'] = valueTypeLookup[v['components'][componentName]['valueType']]
-                            entity.settings['components'] = v['components']
+                            entity.settings['components'] = {**entity.settings['components'], **v['components']} # components added since the save keep their defaults.
                 LinkBlocks()
                 print(f'Previous session state loaded in {time.time() - t:.2f} seconds.')
                 shared.workspace.assistant.PushMessage(f'Loaded saved session from {path}')
@@ -1,7 +1,9 @@
 from multiprocessing import Queue, Process, Event
 import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
 mp.set_start_method('spawn', force = True) # force linux machines to call __getstate__ and __setstate__ methods attached to actions.
 import threading
+from queue import Empty
 import numpy as np
 import time
 from .entity import Entity
@@ -64,6 +66,54 @@ def RunProcess(action, queue, pause, stop, error, sharedMemoryName, shape, dtype
     error.clear()
     queue.put(action.Run(pause, stop, error, sharedMemoryName, shape, dtype, **kwargs))
 
+def AttachSharedArray(sharedMemoryName, shape, dtype):
+    '''Attach to an existing shared memory block. Returns the shared memory and a numpy array view of it.'''
+    sharedMemory = SharedMemory(name = sharedMemoryName)
+    return sharedMemory, np.ndarray(shape, dtype, buffer = sharedMemory.buf)
+
+def AttachSharedArrays(sharedArrays: dict):
+    '''Attach to a dict of (shared memory name, shape, dtype) tuples. Returns the list of shared memories and a dict of arrays under the same keys.'''
+    sharedMemories, arrays = [], dict()
+    for name, (sharedMemoryName, shape, dtype) in sharedArrays.items():
+        sharedMemory, arrays[name] = AttachSharedArray(sharedMemoryName, shape, dtype)
+        sharedMemories.append(sharedMemory)
+    return sharedMemories, arrays
+
+def CloseSharedMemories(sharedMemories):
+    '''Remove this process\' access to each shared memory in `sharedMemories`.'''
+    for sharedMemory in sharedMemories:
+        sharedMemory.close()
+
+def RunWorkers(target, argsList, poll = None, interval = .2):
+    '''Runs `target` in one process for each tuple of args in `argsList` and waits for all of them to finish.\n
+    `target` receives a queue as its final arg and should put exactly one result on it. Returns the list of results (in completion order).
+    A worker that exits without putting a result (e.g. it crashed or ran out of memory) gives an error message in its place.\n
+    `poll` is called every `interval` seconds while waiting, e.g. to aggregate what the workers have written to shared memory so far.'''
+    # one queue per worker, so a worker that has exited can be told apart from one whose result is still on its way.
+    queues = [Queue() for _ in argsList]
+    workers = [Process(target = target, args = (*args, queue)) for args, queue in zip(argsList, queues)]
+    for w in workers:
+        w.start()
+    results, pending = [], list(range(len(workers)))
+    while pending: # empty the queues before joining so workers are not blocked on them.
+        for i in list(pending):
+            # checked before the queue, as a worker's result is flushed to its queue before it exits.
+            exited = workers[i].exitcode is not None
+            try:
+                results.append(queues[i].get_nowait())
+            except Empty:
+                if not exited:
+                    continue
+                results.append(f'Worker process {i} exited with code {workers[i].exitcode} before reporting a result.')
+            pending.remove(i)
+        if poll:
+            poll()
+        if pending:
+            time.sleep(interval)
+    for w in workers:
+        w.join()
+    return results
+
 def WaitForSaveToFinish(entity, saveProcess, deltaTime, lastTime):
     deltaTime += time.time() - lastTime
     lastTime = time.time()
@@ -115,6 +165,9 @@ def PerformAction(entity: Entity, emptyDataArray: np.ndarray, **kwargs) -> bool:
     Supply an `emptyDataArray` numpy array of the final shape.\n
     Supply an attribute name `postProcessedDataName` for the post processed data to be stored in.\n
     If post processing, also supply an `emptyPostProcessedDataArray` numpy array of the final shape.\n
+    Supply `additionalDataArrays`, a dict of attribute names and empty numpy arrays, to share further arrays with the process.
+    The action receives them as `additionalSharedMemory`, a dict of (shared memory name, shape, dtype) tuples.\n
+    Supply an `action` to run instead of the entity's offline or online action.\n
     Returns True if successful else False.'''
     if entity.ID in runningActions:
         if runningActions[entity.ID][0].is_set():
@@ -128,6 +181,7 @@ def PerformAction(entity: Entity, emptyDataArray: np.ndarray, **kwargs) -> bool:
         emptyPostProcessedDataArray = kwargs.pop('emptyPostProcessedDataArray', None)
         if emptyPostProcessedDataArray.shape != ():
             entity.CreateEmptySharedData(emptyPostProcessedDataArray, postProcessedDataName)
+            getattr(entity, postProcessedDataName)[:] = np.nan
             # assign additional kwargs for post processing
             kwargs['postProcessedSharedMemoryName'] = getattr(entity, f'{postProcessedDataName}SharedMemory').name
             kwargs['postProcessedShape'] = emptyPostProcessedDataArray.shape
@@ -135,11 +189,19 @@ def PerformAction(entity: Entity, emptyDataArray: np.ndarray, **kwargs) -> bool:
         else: # user has supplied a name for the post process but not an empty array, so raise an error.
             print('Post processing attribute name was supplied without also providing an empty numpy array!')
             return
+    # Additional post processed arrays are shared under their own attribute names.
+    additionalDataArrays = kwargs.pop('additionalDataArrays', dict())
+    if additionalDataArrays:
+        kwargs['additionalSharedMemory'] = dict()
+        for name, emptyArray in additionalDataArrays.items():
+            entity.CreateEmptySharedData(emptyArray, name)
+            getattr(entity, name)[:] = np.nan if np.issubdtype(emptyArray.dtype, np.floating) else 0
+            kwargs['additionalSharedMemory'][name] = (getattr(entity, f'{name}SharedMemory').name, emptyArray.shape, emptyArray.dtype)
     entity.CreateEmptySharedData(emptyDataArray) # share the data with the process.
     entity.data[:] = np.nan # Initialise data array to NaNs.
         
     queue = Queue()
-    action = entity.offlineAction if not entity.online else entity.onlineAction
+    action = kwargs.pop('action', None) or (entity.offlineAction if not entity.online else entity.onlineAction)
     # Define the pause and stop events and add them to the runningActions dict.
     runningActions[entity.ID] = [Event(), Event(), Event()] # pause, stop, error
     # Instantiate a process